@@ -0,0 +1,163 @@
+import math
+import torch
+import torch.nn.functional as F
+
+from code.training.auxiliary import IMAGENET_MEAN, IMAGENET_STD
+
+"""
+    Batched augmentation: the cfg augmentations (flip, Gaussian blur, affine, color jitter) applied to whole
+    collated uint8 batches on the training device, with independent random parameters for every sample
+    drawn from a seeded generator.
+"""
+
+
+def _uniform(generator, n, low, high, device):
+    return torch.rand(n, device=device, generator=generator) * (high - low) + low
+
+
+def _blend(img1, img2, ratio):
+    return (ratio * img1 + (1.0 - ratio) * img2).clamp(0.0, 1.0)
+
+
+def _grayscale(images):
+    r, g, b = images.unbind(dim=1)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(1)
+
+
+def _rgb_to_hsv(images):
+    r, g, b = images.unbind(dim=1)
+    maxc = images.max(dim=1).values
+    minc = images.min(dim=1).values
+    eqc = maxc == minc
+
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim=1)
+
+
+def _hsv_to_rgb(images):
+    h, s, v = images.unbind(dim=1)
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.to(torch.int64) % 6
+
+    p = (v * (1.0 - s)).clamp(0.0, 1.0)
+    q = (v * (1.0 - s * f)).clamp(0.0, 1.0)
+    t = (v * (1.0 - s * (1.0 - f))).clamp(0.0, 1.0)
+
+    mask = (i.unsqueeze(1) == torch.arange(6, device=i.device).view(1, -1, 1, 1)).to(images.dtype)
+    r = (mask * torch.stack((v, q, p, p, t, v), dim=1)).sum(dim=1)
+    g = (mask * torch.stack((t, v, v, q, p, p), dim=1)).sum(dim=1)
+    b = (mask * torch.stack((p, p, t, v, v, q), dim=1)).sum(dim=1)
+    return torch.stack((r, g, b), dim=1)
+
+
+class BatchAugmentation:
+    def __init__(self, cfg, device, augment=True, seed=None):
+        self.cfg = cfg
+        self.device = device
+        self.augment = augment
+
+        self.generator = torch.Generator(device=device)
+        self.generator.manual_seed(cfg['seed'] if seed is None else seed)
+
+        self.mean = torch.tensor(IMAGENET_MEAN, device=device).view(1, 3, 1, 1)
+        self.std = torch.tensor(IMAGENET_STD, device=device).view(1, 3, 1, 1)
+
+    def __call__(self, images):
+        # uint8 batches are converted here, after the host to device copy
+        if images.dtype == torch.uint8:
+            images = images.float().div_(255)
+
+        if self.augment:
+            if self.cfg['fliplr']:
+                images = self.flip(images)
+            if self.cfg['gaussian_blur']:
+                images = self.gaussian_blur(images)
+            if self.cfg['affine']:
+                images = self.affine(images)
+            if self.cfg['jitter']:
+                images = self.color_jitter(images)
+
+        return (images - self.mean) / self.std
+
+    def flip(self, images, p=0.5):
+        mask = torch.rand(images.size(0), device=images.device, generator=self.generator) < p
+        return torch.where(mask.view(-1, 1, 1, 1), images.flip(-1), images)
+
+    def gaussian_blur(self, images):
+        n, c, h, w = images.shape
+        kernel_size = int(self.cfg['gaussian_kernel'])
+        sigma = _uniform(self.generator, n, self.cfg['sigma_min'], self.cfg['sigma_max'], images.device)
+
+        # one normalised 1D kernel per sample, applied separably as a grouped convolution
+        half = (kernel_size - 1) * 0.5
+        x = torch.linspace(-half, half, kernel_size, device=images.device)
+        kernel = torch.exp(-0.5 * (x.view(1, -1) / sigma.view(-1, 1)).pow(2))
+        kernel = kernel / kernel.sum(dim=1, keepdim=True)
+        kernel = kernel.repeat_interleave(c, dim=0)
+
+        pad = kernel_size // 2
+        out = images.reshape(1, n * c, h, w)
+        out = F.pad(out, [pad, pad, pad, pad], mode='reflect')
+        out = F.conv2d(out, kernel.view(n * c, 1, 1, kernel_size), groups=n * c)
+        out = F.conv2d(out, kernel.view(n * c, 1, kernel_size, 1), groups=n * c)
+        return out.view(n, c, h, w)
+
+    def affine(self, images):
+        n, _, h, w = images.shape
+        degrees = self.cfg['affine_percent']
+        angle = _uniform(self.generator, n, -degrees, degrees, images.device) * math.pi / 180
+        scale = _uniform(self.generator, n, self.cfg['affine_scale_min'], self.cfg['affine_scale_max'], images.device)
+
+        # inverse mapping from output to input coordinates, counter-clockwise rotation around the center
+        cos = torch.cos(angle) / scale
+        sin = torch.sin(angle) / scale
+        zeros = torch.zeros_like(cos)
+        theta = torch.stack([
+            torch.stack([cos, sin * h / w, zeros], dim=1),
+            torch.stack([-sin * w / h, cos, zeros], dim=1)
+        ], dim=1)
+
+        grid = F.affine_grid(theta, list(images.shape), align_corners=False)
+        return F.grid_sample(images, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+    def color_jitter(self, images):
+        n = images.size(0)
+        low, high = self.cfg['jitter_min'], self.cfg['jitter_max']
+        brightness = _uniform(self.generator, n, low, high, images.device).view(-1, 1, 1, 1)
+        contrast = _uniform(self.generator, n, low, high, images.device).view(-1, 1, 1, 1)
+        saturation = _uniform(self.generator, n, low, high, images.device).view(-1, 1, 1, 1)
+        hue = _uniform(self.generator, n, -self.cfg['jitter_hue'], self.cfg['jitter_hue'], images.device)
+
+        # like ColorJitter, every sample applies the four adjustments in its own random order
+        order = torch.argsort(torch.rand(n, 4, device=images.device, generator=self.generator), dim=1)
+        for step in range(4):
+            for op in range(4):
+                index = torch.nonzero(order[:, step] == op).flatten()
+                if index.numel() == 0:
+                    continue
+                subset = images[index]
+                if op == 0:
+                    subset = (subset * brightness[index]).clamp(0.0, 1.0)
+                elif op == 1:
+                    mean = _grayscale(subset).mean(dim=(1, 2, 3), keepdim=True)
+                    subset = _blend(subset, mean, contrast[index])
+                elif op == 2:
+                    subset = _blend(subset, _grayscale(subset), saturation[index])
+                else:
+                    hsv = _rgb_to_hsv(subset)
+                    h = (hsv[:, 0] + hue[index].view(-1, 1, 1)) % 1.0
+                    subset = _hsv_to_rgb(torch.stack((h, hsv[:, 1], hsv[:, 2]), dim=1))
+                images = images.index_copy(0, index, subset)
+        return images
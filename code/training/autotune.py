@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import hashlib
+import platform
+import tempfile
+import torch
+from torch.utils import data
+
+try:
+    import fcntl
+except ImportError:  # Windows, the tuning file is written without a lock
+    fcntl = None
+
+"""
+    DataLoader autotuning: candidate worker counts, prefetch factors and pinning are timed on the actual
+    dataset, transform and batch size, and the fastest setting is cached per machine and configuration.
+"""
+
+LOADER_TUNING_PATH = 'loader_tuning.json'
+
+DEFAULT_LOADER_SETTINGS = {'num_workers': 2, 'prefetch_factor': 4, 'pin_memory': True}
+
+
+def loader_key(set_data, batch_size):
+    machine = [platform.node(), os.cpu_count(), torch.__version__, torch.cuda.is_available()]
+    config = [type(set_data).__name__, len(set_data), repr(getattr(set_data, 'transform', None)), batch_size]
+    return hashlib.sha1(json.dumps(machine + config, default=str).encode()).hexdigest()
+
+
+def _read_tuning(tuning_path):
+    if not os.path.exists(tuning_path):
+        return {}
+    with open(tuning_path, 'r') as f:
+        return json.load(f)
+
+
+def _write_tuning(tuning_path, key, settings):
+    # concurrent sweep jobs merge their settings one at a time, each through its own temporary file
+    with open(tuning_path + '.lock', 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        tuning = _read_tuning(tuning_path)
+        tuning[key] = settings
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(tuning_path)), suffix='.tmp',
+                                         delete=False) as f:
+            json.dump(tuning, f, indent=2)
+        os.replace(f.name, tuning_path)
+
+
+def get_loader_settings(set_data, batch_size, tuning_path=LOADER_TUNING_PATH):
+    return _read_tuning(tuning_path).get(loader_key(set_data, batch_size))
+
+
+def loader_kwargs(settings):
+    if settings['num_workers'] == 0:
+        return {'num_workers': 0, 'pin_memory': settings['pin_memory']}
+    return {'num_workers': settings['num_workers'], 'prefetch_factor': settings['prefetch_factor'],
+            'pin_memory': settings['pin_memory'], 'persistent_workers': True}
+
+
+def _benchmark(set_data, batch_size, settings, num_batches):
+    kwargs = loader_kwargs(settings)
+    kwargs['persistent_workers'] = False
+    shuffle = not isinstance(set_data, data.IterableDataset)
+    loader = data.DataLoader(set_data, batch_size=batch_size, shuffle=shuffle, **kwargs)
+
+    # the first batch pays the worker start-up, only the steady state is timed when there is one
+    start = time.perf_counter()
+    iterator = iter(loader)
+    next(iterator, None)
+    first_batch = time.perf_counter() - start
+    count = 0
+    start = time.perf_counter()
+    for images, _ in iterator:
+        if settings['pin_memory'] and torch.cuda.is_available():
+            images.to('cuda', non_blocking=True)
+        count += 1
+        if count == num_batches:
+            break
+    elapsed = time.perf_counter() - start
+    del iterator
+    if count == 0:
+        return 1.0 / first_batch
+    return count / elapsed
+
+
+def autotune_loader(set_data, batch_size, num_batches=20, tuning_path=LOADER_TUNING_PATH):
+    cpu_count = os.cpu_count() or 1
+    worker_candidates = [0] + [n for n in [1, 2, 4, 8, 12, 16, 24, 32, 48, 64] if n <= cpu_count]
+    pin_candidates = [False, True] if torch.cuda.is_available() else [False]
+
+    # coordinate search: worker count first, then prefetch factor, then pinning
+    best = {'num_workers': 0, 'prefetch_factor': 2, 'pin_memory': False}
+    best_speed = 0.0
+    for num_workers in worker_candidates:
+        settings = dict(best, num_workers=num_workers)
+        speed = _benchmark(set_data, batch_size, settings, num_batches)
+        print('Loader with {} workers: {:.2f} batches/s'.format(num_workers, speed))
+        if speed > best_speed:
+            best, best_speed = settings, speed
+
+    if best['num_workers'] > 0:
+        for prefetch_factor in [4, 8]:
+            settings = dict(best, prefetch_factor=prefetch_factor)
+            speed = _benchmark(set_data, batch_size, settings, num_batches)
+            print('Loader with prefetch factor {}: {:.2f} batches/s'.format(prefetch_factor, speed))
+            if speed > best_speed:
+                best, best_speed = settings, speed
+
+    for pin_memory in pin_candidates:
+        if pin_memory == best['pin_memory']:
+            continue
+        settings = dict(best, pin_memory=pin_memory)
+        speed = _benchmark(set_data, batch_size, settings, num_batches)
+        if speed > best_speed:
+            best, best_speed = settings, speed
+
+    _write_tuning(tuning_path, loader_key(set_data, batch_size), best)
+
+    print(f'Selected loader settings: {best}')
+    return best
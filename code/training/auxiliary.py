@@ -1,51 +1,160 @@
 import os
-import shutil
+import copy
+import atexit
+import functools
 import random
 import torchvision
 import torch
 from torch.utils import data
+from torchvision import transforms
 
+from code.training.autotune import DEFAULT_LOADER_SETTINGS, autotune_loader, get_loader_settings, loader_kwargs
+from code.training.decoding import draft_loader
+from code.training.distributed import get_sampler, get_rank, get_world_size
+from code.training.manifest import write_manifest, get_source_dataset, source_version
+from code.training.shards import ShardDataset, shards_exist, get_shards_path
+from code.training.tensor_cache import TensorCacheDataset, tensor_cache_exists, get_cache_path
 
-def create_sets(original_folder_path, total=None):
-    training_folder_path = "sets/training"
-    validation_folder_path = "sets/validation"
-    test_folder_path = "sets/test"
-
-    os.makedirs(training_folder_path, exist_ok=True)
-    os.makedirs(validation_folder_path, exist_ok=True)
-    os.makedirs(test_folder_path, exist_ok=True)
-
-    # List all directories in the original folder
-    directories = os.listdir(original_folder_path)
-
-    # Move directories to the new folders
-    for i, directory in enumerate(directories):
-        images = os.listdir(os.path.join(original_folder_path, directory))
-        total_images = len(images)
-        if total is not None:
-            total_images = total
-        training_count = int(total_images * 0.7)
-        validation_count = int(total_images * 0.2)
-
-        for j in range(int(total_images)):
-            if j < training_count:
-                destination_path = os.path.join(training_folder_path, directory)
-            elif j < training_count + validation_count:
-                destination_path = os.path.join(validation_folder_path, directory)
-            else:
-                destination_path = os.path.join(test_folder_path, directory)
-            if not os.path.exists(destination_path):
-                os.makedirs(destination_path)
-            shutil.copy(os.path.join(original_folder_path, directory, images[j]), destination_path)
-
-
-def create_dataloader(set_path, transform, batch_size=1024):
-    set_data = torchvision.datasets.ImageFolder(root=set_path, transform=transform)
-    set_loader = data.DataLoader(set_data, batch_size=batch_size, shuffle=True, num_workers=2, prefetch_factor=4,
-                                 pin_memory=True, persistent_workers=True)
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+_DATASETS = {}
+_LOADERS = {}
+
+
+def create_sets(original_folder_path, total=None, seed=42):
+    # the splits are recorded in sets/manifest.csv, images are read from the original folder
+    return write_manifest(original_folder_path, total, seed)
+
+
+def get_transform(cfg, shape, augment=False, tensor_input=False):
+    # tensor inputs come from the tensor cache, already resized and stored as uint8
+    transforms_list = [] if tensor_input else [transforms.Resize(shape)]
+
+    # with batch augmentation samples stay uint8, augmentation and normalization run on the device
+    if cfg.get('batch_augmentation', False):
+        if not tensor_input:
+            transforms_list.append(transforms.PILToTensor())
+        return transforms.Compose(transforms_list)
+
+    if augment:
+        if cfg['fliplr']:  # horizontal flip
+            transforms_list.append(transforms.RandomHorizontalFlip())
+        if cfg['gaussian_blur']:  # Gaussian blur
+            transforms_list.append(transforms.GaussianBlur(cfg['gaussian_kernel'], (cfg['sigma_min'], cfg['sigma_max'])))
+        if cfg['affine']:  # affine
+            transforms_list.append(
+                transforms.RandomAffine(cfg['affine_percent'], scale=(cfg['affine_scale_min'], cfg['affine_scale_max'])))
+        if cfg['jitter']:
+            transforms_list.append(
+                transforms.ColorJitter(brightness=(cfg['jitter_min'], cfg['jitter_max']),
+                                       contrast=(cfg['jitter_min'], cfg['jitter_max']),
+                                       hue=cfg['jitter_hue'],
+                                       saturation=(cfg['jitter_min'], cfg['jitter_max'])))
+
+    if tensor_input:
+        transforms_list.append(transforms.ConvertImageDtype(torch.float))
+    else:
+        transforms_list.append(transforms.ToTensor())
+    transforms_list.append(transforms.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD))
+    return transforms.Compose(transforms_list)
+
+
+def _cached_dataset(key, version, build, transform, loader=None):
+    # the file index of a split is built once per process and shared by every transform using it
+    if (key, version) not in _DATASETS:
+        for stale in [cached for cached in _DATASETS if cached[0] == key]:
+            del _DATASETS[stale]
+        _DATASETS[(key, version)] = build()
+    set_data = copy.copy(_DATASETS[(key, version)])
+    # the loaders built on this dataset are replaced when the version changes
+    set_data.version = version
+    set_data.transform = transform
+    if loader is not None:
+        set_data.loader = loader
+    return set_data
+
+
+def create_dataset(set_path, cfg, shape, augment=False):
+    set_path = os.path.abspath(set_path)
+    # JPEGs are decoded directly at the smallest scale still covering the input shape
+    loader = functools.partial(draft_loader, shape=shape if cfg.get('draft_decode', True) else None)
+    # use the pre-decoded tensor cache when it has been built for this shape
+    if tensor_cache_exists(set_path, shape):
+        return _cached_dataset(('tensor_cache', set_path, tuple(shape)),
+                               os.path.getmtime(os.path.join(get_cache_path(set_path, shape), 'meta.json')),
+                               lambda: TensorCacheDataset(set_path, shape),
+                               get_transform(cfg, shape, augment, tensor_input=True))
+    # then the sequential-read shards, then the individual files
+    if shards_exist(set_path):
+        return _cached_dataset(('shards', set_path, augment, cfg['seed']),
+                               os.path.getmtime(os.path.join(get_shards_path(set_path), 'index.json')),
+                               lambda: ShardDataset(set_path, shuffle=augment, seed=cfg['seed']),
+                               get_transform(cfg, shape, augment), loader)
+    # the same version as the tensor cache and shards: the manifest, or the split and class folders
+    return _cached_dataset(('files', set_path), source_version(set_path),
+                           lambda: get_source_dataset(set_path),
+                           get_transform(cfg, shape, augment), loader)
+
+
+def create_dataloader(set_data, batch_size=1024, shuffle=True, autotune=False, defaults=DEFAULT_LOADER_SETTINGS,
+                      sampler=None):
+    # loader settings tuned for this machine and dataset, when available
+    settings = get_loader_settings(set_data, batch_size)
+    if settings is None and autotune:
+        settings = autotune_loader(set_data, batch_size)
+    if settings is None:
+        settings = defaults
+
+    # iterable datasets (shards) shuffle internally
+    shuffle = shuffle and not isinstance(set_data, data.IterableDataset) and sampler is None
+    set_loader = data.DataLoader(set_data, batch_size=batch_size, shuffle=shuffle, sampler=sampler,
+                                 **loader_kwargs(settings))
     return set_loader
 
 
+def get_dataloader(set_path, cfg, shape, batch_size=1024, augment=False, shuffle=True):
+    # loaders, and their persistent workers, are reused by every later call with the same split,
+    # shape, transform and batch size, until the manifest, shard index or tensor cache they read changes
+    set_data = create_dataset(set_path, cfg, shape, augment)
+    key = (os.path.abspath(set_path), tuple(shape), type(set_data).__name__, repr(set_data.transform),
+           repr(getattr(set_data, 'loader', None)), batch_size, shuffle, get_rank(), get_world_size())
+    version, set_loader = _LOADERS.get(key, (None, None))
+    if set_loader is None or version != set_data.version:
+        # the workers of a replaced loader exit once it is no longer referenced
+        _LOADERS.pop(key, None)
+        # in distributed runs every process reads its own part of the split
+        sampler = get_sampler(set_data, shuffle, cfg['seed'])
+        _LOADERS[key] = (set_data.version, create_dataloader(set_data, batch_size, shuffle,
+                                                             autotune=cfg.get('autotune_loader', False),
+                                                             sampler=sampler))
+    return _LOADERS[key][1]
+
+
+def release_dataloader(set_loader):
+    # the loader is no longer returned by get_dataloader, its workers exit once the caller drops it too
+    for key, (_, cached) in list(_LOADERS.items()):
+        if cached is set_loader:
+            del _LOADERS[key]
+
+
+def set_loader_epoch(set_loader, epoch):
+    # shards shuffle internally, distributed samplers split the split differently every epoch
+    if hasattr(set_loader.dataset, 'set_epoch'):
+        set_loader.dataset.set_epoch(epoch)
+    if hasattr(set_loader.sampler, 'set_epoch'):
+        set_loader.sampler.set_epoch(epoch)
+
+
+def shutdown_dataloaders():
+    # dropping the references lets every DataLoader shut its workers down
+    _LOADERS.clear()
+    _DATASETS.clear()
+
+
+atexit.register(shutdown_dataloaders)
+
+
 def get_device(seed):
     if torch.cuda.is_available():
         device = torch.device('cuda')
@@ -53,3 +162,14 @@ def get_device(seed):
     else:
         device = torch.device('cpu')
     return device
+
+
+def get_amp_dtype(cfg):
+    # None keeps the model in fp32, bfloat16 is the autocast type supported on CPU
+    if not cfg.get('mixed_precision', False):
+        return None
+    return getattr(torch, cfg.get('amp_dtype', 'bfloat16'))
+
+
+def get_memory_format(cfg):
+    return torch.channels_last if cfg.get('channels_last', False) else None
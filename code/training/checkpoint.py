@@ -0,0 +1,99 @@
+import os
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+"""
+    Resumable checkpoints: the full training state (weights, optimizer, scheduler, gradient scaler, epoch,
+    early-stopping counters, metric history and random number generator states) is saved every epoch to
+    models/<model_name>/checkpoint.pt. Tensors are copied to host memory on the training thread, then a
+    background thread serialises them to a temporary file that replaces the previous checkpoint in one rename,
+    so a crash never leaves a truncated checkpoint and the next epoch starts without waiting for the disk.
+"""
+
+
+def get_checkpoint_path(model_name, models_dir='models'):
+    return os.path.join(models_dir, model_name, 'checkpoint.pt')
+
+
+def snapshot(state):
+    # detached host copies, the training loop keeps updating the originals in place
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def get_rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if torch.cuda.is_available() and 'cuda' in state:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def write_atomic(state, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, device=torch.device('cpu')):
+    if not os.path.exists(path):
+        return None
+    # the random number generator states are plain python and numpy objects
+    return torch.load(path, map_location=device, weights_only=False)
+
+
+class AsyncCheckpointer:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            state, path = item
+            try:
+                write_atomic(state, path)
+            except Exception as e:
+                self.error = e
+                print(f'Saving {path} failed: {e}')
+            finally:
+                self.queue.task_done()
+
+    def save(self, state, path):
+        # snapshots are written in submission order by the background thread
+        self.queue.put((snapshot(state), path))
+
+    def wait(self):
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        # the thread ends after writing what is already queued
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
@@ -0,0 +1,89 @@
+import os
+import hashlib
+import torch
+
+"""
+    Compiled execution: 'compile' wraps the model with torch.compile, whose generated kernels are kept in the
+    Inductor cache under cache/compile, and 'trace' builds a frozen TorchScript graph for inference that is
+    saved next to the weights. Any architecture that fails to compile runs eagerly.
+"""
+
+COMPILE_CACHE_DIR = os.path.join('cache', 'compile')
+
+
+def unwrap_model(model):
+    # state_dicts are always saved from the eager module, without the torch.compile or DDP prefixes
+    model = getattr(model, '_orig_mod', model)
+    if isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        model = model.module
+    return model
+
+
+def _trace_key(model, shape, weights_path, device, memory_format, optimize):
+    # the frozen graph depends on where and how it was traced, as well as on the weights
+    key = [torch.__version__, str(shape), type(model).__name__, str(device), str(memory_format), str(optimize)]
+    if weights_path is not None and os.path.exists(weights_path):
+        key.append(str(os.path.getmtime(weights_path)))
+    return hashlib.sha1(' '.join(key).encode()).hexdigest()
+
+
+def _warm_up(model, example, train):
+    # compilation is lazy: run the graphs once so failures show up here, and restore what training mode changed
+    state = {name: value.clone() for name, value in model.state_dict().items()}
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        model(example)
+    if train:
+        model.train()
+        model(example).float().sum().backward()
+        model.zero_grad(set_to_none=True)
+        model.load_state_dict(state)
+    model.train(was_training)
+
+
+def compile_model(model, shape, compile_mode=None, device=torch.device('cpu'), train=False, weights_path=None,
+                  memory_format=None, optimize=False):
+    if not compile_mode:
+        return model
+
+    # the example has the layout of the real inputs, the graphs are specialized to it
+    example = torch.randn(2, 3, *shape, device=device)
+    if memory_format is not None:
+        example = example.contiguous(memory_format=memory_format)
+    try:
+        if compile_mode == 'compile':
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(os.path.join(COMPILE_CACHE_DIR,
+                                                                                          'inductor')))
+            compiled = torch.compile(model)
+            _warm_up(compiled, example, train)
+            return compiled
+
+        if compile_mode == 'trace':
+            if train:
+                print('TorchScript tracing is inference only, training eagerly')
+                return model
+            # frozen graphs embed the weights: they are stored next to the weight file and rebuilt when it or
+            # torch change, models without saved weights are traced every time
+            key = _trace_key(model, shape, weights_path, device, memory_format, optimize)
+            traced_path = None
+            if weights_path is not None and os.path.exists(weights_path):
+                traced_path = os.path.splitext(weights_path)[0] + '_traced.pt'
+
+            if traced_path is not None and os.path.exists(traced_path):
+                extra_files = {'key': ''}
+                traced = torch.jit.load(traced_path, map_location=device, _extra_files=extra_files)
+                if extra_files['key'] in [key, key.encode()]:
+                    return traced
+
+            model.eval()
+            with torch.no_grad():
+                traced = torch.jit.freeze(torch.jit.trace(model, example))
+            if traced_path is not None:
+                torch.jit.save(traced, traced_path, _extra_files={'key': key})
+            return traced
+
+        print(f'Unknown compile mode {compile_mode}, running eagerly')
+    except Exception as e:
+        print(f'Compilation of {type(model).__name__} failed, running eagerly: {e}')
+    return model
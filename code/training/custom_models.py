@@ -63,6 +63,8 @@ class ResidualBlock(nn.Module):
         self.relu = nn.ReLU(inplace=True)
         self.conv2 = nn.Conv2d(out_channels, out_channels, kernel_size=3, stride=1, padding=1, bias=False)
         self.bn2 = nn.BatchNorm2d(out_channels)
+        # a module of its own after the addition, so conv-bn-relu and add-relu can be fused for quantization
+        self.relu2 = nn.ReLU(inplace=True)
 
         # Shortcut connection when the input and output dimensions differ
         if stride != 1 or in_channels != out_channels:
@@ -83,8 +85,8 @@ class ResidualBlock(nn.Module):
         out = self.conv2(out)
         out = self.bn2(out)
 
-        out += self.shortcut(residual)
-        out = self.relu(out)
+        out = out + self.shortcut(residual)
+        out = self.relu2(out)
 
         return out
 
@@ -98,10 +100,11 @@ class ResidualBlock(nn.Module):
 
 
 class CustomDenseNet(nn.Module):
-    def __init__(self, num_classes, growth_rate, block_config):
+    def __init__(self, num_classes, growth_rate, block_config, memory_efficient=None):
         super(CustomDenseNet, self).__init__()
 
         self.growth_rate = growth_rate
+        self.memory_efficient = memory_efficient
         self.num_init_features = 2 * growth_rate
 
         # Initial convolutional layer
@@ -155,6 +158,9 @@ class CustomDenseNet(nn.Module):
             layers.append(DenseBlock(in_channels, self.growth_rate))
             in_channels += self.growth_rate
 
+        # same submodules, and state_dict keys, in both variants
+        if self.memory_efficient:
+            return DenseStage(*layers, recompute=self.memory_efficient == 'recompute')
         return nn.Sequential(*layers)
 
     def _make_transition_block(self, in_channels):
@@ -183,13 +189,130 @@ class TransitionBlock(nn.Module):
         self.bn = nn.BatchNorm2d(in_channels)
         self.conv = nn.Conv2d(in_channels, out_channels, kernel_size=1, stride=1, bias=False)
         self.avgpool = nn.AvgPool2d(kernel_size=2, stride=2)
+        # set for inference by fusion.optimize_for_inference, the 1x1 convolution then runs on the pooled map
+        self.pool_first = False
 
     def forward(self, x):
-        out = self.conv(self.relu(self.bn(x)))
+        out = self.relu(self.bn(x))
+        if self.pool_first:
+            return self.conv(self.avgpool(out))
+        out = self.conv(out)
         out = self.avgpool(out)
         return out
 
 
+"""
+    MEMORY-EFFICIENT DENSE BLOCKS
+"""
+
+
+def _dense_layer(layer, x, training):
+    # BN-ReLU-conv of a DenseBlock, normalising with the batch statistics in training without touching the
+    # running statistics, which the first forward has already updated
+    bn = layer.bn
+    out = F.batch_norm(x, None if training else bn.running_mean, None if training else bn.running_var,
+                       bn.weight, bn.bias, training, 0.0, bn.eps)
+    return layer.conv(F.relu(out))
+
+
+def _dense_buffer(stage, x, dtype):
+    growth = stage[0].conv.out_channels
+    channels_last = x.is_contiguous(memory_format=torch.channels_last) and not x.is_contiguous()
+    buffer = torch.empty((x.size(0), x.size(1) + len(stage) * growth, x.size(2), x.size(3)), dtype=dtype,
+                         device=x.device, memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+    buffer[:, :x.size(1)] = x
+    return buffer
+
+
+class _DenseStageFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, stage, recompute, x, *params):
+        device_type = x.device.type
+        autocast_enabled = torch.is_autocast_enabled(device_type)
+        autocast_dtype = torch.get_autocast_dtype(device_type)
+        ctx.stage = stage
+        ctx.recompute = recompute
+        ctx.autocast = (device_type, autocast_enabled, autocast_dtype)
+
+        # as torch.cat, the buffer has the promoted type of the input and of the (autocast) conv outputs
+        dtype = torch.promote_types(x.dtype, autocast_dtype) if autocast_enabled else x.dtype
+        buffer = _dense_buffer(stage, x, dtype)
+        # without recomputation the graph of every layer is kept: its input is read from an alias of the
+        # buffer, whose version counter is not changed by the writes of the later layers to other channels
+        alias = buffer.data
+        graphs = []
+        channels = x.size(1)
+        for layer in stage:
+            if recompute:
+                out = layer.conv(layer.relu(layer.bn(buffer[:, :channels])))
+            else:
+                with torch.enable_grad():
+                    inputs = alias[:, :channels].detach().requires_grad_()
+                    out = layer.conv(layer.relu(layer.bn(inputs)))
+                graphs.append((inputs, out))
+            buffer[:, channels:channels + out.size(1)] = out.detach()
+            channels += out.size(1)
+
+        ctx.graphs = graphs
+        ctx.save_for_backward(buffer)
+        return buffer
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        buffer, = ctx.saved_tensors
+        stage = ctx.stage
+        device_type, autocast_enabled, autocast_dtype = ctx.autocast
+        grad = grad_output.clone()
+        channels = buffer.size(1)
+        grads = {}
+
+        for index in reversed(range(len(stage))):
+            layer = stage[index]
+            growth = layer.conv.out_channels
+            channels -= growth
+            if ctx.recompute:
+                with torch.enable_grad(), torch.autocast(device_type, autocast_dtype, enabled=autocast_enabled):
+                    inputs = buffer[:, :channels].detach().requires_grad_()
+                    out = _dense_layer(layer, inputs, stage.training)
+            else:
+                inputs, out = ctx.graphs[index]
+            params = [p for p in (layer.bn.weight, layer.bn.bias, layer.conv.weight) if p.requires_grad]
+            results = torch.autograd.grad(out, [inputs] + params,
+                                          grad[:, channels:channels + growth].to(out.dtype))
+            grad[:, :channels] += results[0]
+            for param, param_grad in zip(params, results[1:]):
+                grads[param] = param_grad
+
+        ctx.graphs = None
+        params = [p for layer in stage for p in (layer.bn.weight, layer.bn.bias, layer.conv.weight)]
+        return (None, None, grad[:, :channels]) + tuple(grads.get(p) for p in params)
+
+
+class DenseStage(nn.Sequential):
+    # the DenseBlocks of one stage writing their outputs into a single preallocated concatenation buffer
+    # instead of concatenating all previous features at every layer, optionally recomputing BN-ReLU-conv in
+    # backward so only the buffer is kept between forward and backward
+    def __init__(self, *layers, recompute=False):
+        super(DenseStage, self).__init__(*layers)
+        self.recompute = recompute
+
+    def forward(self, x):
+        params = [p for layer in self for p in (layer.bn.weight, layer.bn.bias, layer.conv.weight)]
+        if torch.is_grad_enabled() and (x.requires_grad or any(p.requires_grad for p in params)):
+            return _DenseStageFunction.apply(self, self.recompute, x, *params)
+
+        # inference only needs the buffer
+        buffer = None
+        channels = x.size(1)
+        for layer in self:
+            out = layer.conv(layer.relu(layer.bn(x if buffer is None else buffer[:, :channels])))
+            if buffer is None:
+                buffer = _dense_buffer(self, x, torch.promote_types(x.dtype, out.dtype))
+            buffer[:, channels:channels + out.size(1)] = out
+            channels += out.size(1)
+        return buffer
+
+
 """
     CUSTOM RESNET WITH SEBLOCK
 """
@@ -206,16 +329,14 @@ class SEBlock(nn.Module):
         self.sigmoid = nn.Sigmoid()
 
     def forward(self, x):
-        b, c, _, _ = x.size()
-
-        out = self.avgpool(x).view(b, c)
+        # no unpacking of the input size, which FX tracing would turn into graph inputs
+        out = torch.flatten(self.avgpool(x), 1)
         out = self.fc1(out)
         out = self.relu(out)
         out = self.fc2(out)
         out = self.sigmoid(out)
 
-        out = out.view(b, c, 1, 1)
-        out = x * out
+        out = x * out[:, :, None, None]
 
         return out
 
@@ -241,6 +362,7 @@ class BasicBlock(nn.Module):
         )
         self.bn2 = nn.BatchNorm2d(out_channels * self.expansion)
         self.se = SEBlock(out_channels * self.expansion, reduction_ratio)
+        self.relu2 = nn.ReLU(inplace=True)
 
         if stride != 1 or in_channels != out_channels * self.expansion:
             self.downsample = nn.Sequential(
@@ -270,8 +392,8 @@ class BasicBlock(nn.Module):
         if self.downsample is not None:
             identity = self.downsample(x)
 
-        out += identity
-        out = self.relu(out)
+        out = out + identity
+        out = self.relu2(out)
 
         return out
 
@@ -0,0 +1,157 @@
+import os
+import hashlib
+import functools
+import torch
+from torch import nn
+from torch.nn import functional as F
+from torch.utils import data
+
+from code.training.models import get_model
+from code.training.auxiliary import create_dataset, create_dataloader, get_transform
+from code.training.decoding import draft_loader
+from code.training.distributed import get_sampler
+from code.training.manifest import MANIFEST_PATH, get_source_dataset
+from code.training.feature_cache import load_feature_cache, write_feature_cache
+
+"""
+    Knowledge distillation: a trained teacher (cfg teacher_model, weights in teacher_models_dir/<name>/<name>.pkl,
+    custom teachers built with teacher_layers) supervises the student with its softened outputs next to the hard
+    labels. The teacher runs once per training image and augmented variant, before training, and its logits are
+    cached in models/<model_name>/teacher_logits.
+
+    The augmentation of every (image, variant) pair is drawn from its own seed, so the teacher, at its input
+    shape, and the student, at its own, see the same flip, blur, affine and jitter parameters of an image. Each
+    epoch the student draws one of the distillation_variants variants of every image, as with the feature cache.
+    Augmentation runs per sample for this, batch_augmentation only applies to the validation images.
+
+    Loss: alpha * T^2 * KL(teacher || student, at temperature T) + (1 - alpha) * cross-entropy with the labels.
+"""
+
+
+def _sample_seed(seed, index, variant):
+    return (seed * 1000003 + index) * 1009 + variant
+
+
+def _seeded_item(set_data, seed, index, variant):
+    # the global generator of the process is left as it was, the variant draw keeps its own sequence
+    with torch.random.fork_rng(devices=[]):
+        torch.manual_seed(_sample_seed(seed, index, variant))
+        return set_data[index]
+
+
+class SeededDataset(data.Dataset):
+    def __init__(self, set_data, seed, variant):
+        self.set_data = set_data
+        self.seed = seed
+        self.variant = variant
+
+    def __len__(self):
+        return len(self.set_data)
+
+    def __getitem__(self, index):
+        return _seeded_item(self.set_data, self.seed, index, self.variant)
+
+
+class DistillationDataset(data.Dataset):
+    def __init__(self, set_data, seed, logits):
+        self.set_data = set_data
+        self.seed = seed
+        self.logits = logits
+        self.variants = logits.shape[1]
+
+    def __len__(self):
+        return len(self.set_data)
+
+    def __getitem__(self, index):
+        variant = int(torch.randint(self.variants, ())) if self.variants > 1 else 0
+        image, label = _seeded_item(self.set_data, self.seed, index, variant)
+        # the label travels in front of the teacher logits of the same variant
+        target = torch.cat([torch.tensor([float(label)]), torch.as_tensor(self.logits[index, variant]).float()])
+        return image, target
+
+
+class DistillationLoss(nn.Module):
+    def __init__(self, temperature=4.0, alpha=0.9):
+        super(DistillationLoss, self).__init__()
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def forward(self, outputs, targets):
+        outputs = outputs.float()
+        labels, teacher = targets[:, 0].long(), targets[:, 1:]
+        soft = F.kl_div(F.log_softmax(outputs / self.temperature, dim=1),
+                        F.log_softmax(teacher / self.temperature, dim=1), reduction='batchmean', log_target=True)
+        hard = F.cross_entropy(outputs, labels)
+        return self.alpha * self.temperature ** 2 * soft + (1 - self.alpha) * hard
+
+
+def create_seeded_dataset(set_path, cfg, shape):
+    # per-sample augmentation on an indexable dataset, shards are read in their own order and cannot be seeded
+    sample_cfg = dict(cfg, batch_augmentation=False)
+    set_data = create_dataset(set_path, sample_cfg, shape, augment=True)
+    if isinstance(set_data, data.IterableDataset):
+        set_data = get_source_dataset(set_path, get_transform(sample_cfg, shape, augment=True))
+        set_data.loader = functools.partial(draft_loader, shape=shape if cfg.get('draft_decode', True) else None)
+    return set_data
+
+
+def _cache_key(cfg, set_path, teacher_shape, variants):
+    teacher_model = cfg['teacher_model']
+    key = [torch.__version__, teacher_model, str(cfg.get('teacher_layers')), str(teacher_shape), os.path.abspath(set_path), str(variants),
+           str(cfg['seed']), repr(get_transform(dict(cfg, batch_augmentation=False), teacher_shape, augment=True))]
+    weights_path = os.path.join(cfg.get('teacher_models_dir', 'models'), teacher_model, f'{teacher_model}.pkl')
+    key.append(str(os.path.getmtime(weights_path)))
+    if os.path.exists(MANIFEST_PATH):
+        key.append(str(os.path.getmtime(MANIFEST_PATH)))
+    return hashlib.sha1(' '.join(key).encode()).hexdigest()
+
+
+def extract_logits(teacher, set_data, seed, variants, device, amp_dtype=None, batch_size=64):
+    teacher.eval()
+    logits = []
+    labels = []
+    with torch.no_grad():
+        for variant in range(variants):
+            loader = create_dataloader(SeededDataset(set_data, seed, variant), batch_size, shuffle=False)
+            variant_logits = []
+            for images, targets in loader:
+                with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                    variant_logits.append(teacher(images.to(device)).float().cpu())
+                if variant == 0:
+                    labels.append(targets)
+            logits.append(torch.cat(variant_logits))
+    # (N, variants, num_classes)
+    return torch.stack(logits, dim=1), torch.cat(labels)
+
+
+def get_teacher_logits(cfg, set_path, num_classes, device, amp_dtype=None, batch_size=64):
+    teacher_model = cfg['teacher_model']
+    # the teacher is read from the baseline models folder, also for sweep and search jobs with their own
+    teacher_models_dir = cfg.get('teacher_models_dir', 'models')
+    weights_path = os.path.join(teacher_models_dir, teacher_model, f'{teacher_model}.pkl')
+    if not os.path.exists(weights_path):
+        raise FileNotFoundError(f'Teacher weights {weights_path} not found, train {teacher_model} first')
+
+    # built with its own layers, the trained weights are loaded without any layer to fine-tune
+    teacher_layers = cfg.get('teacher_layers') or cfg['layers']
+    teacher, teacher_shape = get_model(teacher_model, False, None, True, num_classes, teacher_layers,
+                                       models_dir=teacher_models_dir, optimize=cfg.get('optimize_inference', True))
+    variants = max(1, cfg.get('distillation_variants', 1))
+    key = _cache_key(cfg, set_path, teacher_shape, variants)
+    cache_path = os.path.join(cfg.get('models_dir', 'models'), cfg['model_name'], 'teacher_logits')
+    cached = load_feature_cache(cache_path, key)
+    if cached is not None:
+        return cached.features
+
+    print(f'Computing the logits of {teacher_model} for {variants} variants of every training image')
+    set_data = create_seeded_dataset(set_path, cfg, teacher_shape)
+    logits, labels = extract_logits(teacher.to(device), set_data, cfg['seed'], variants, device, amp_dtype,
+                                    batch_size)
+    write_feature_cache(cache_path, key, logits, labels, getattr(set_data, 'classes', None))
+    return logits.numpy()
+
+
+def get_distillation_loader(set_path, cfg, shape, batch_size, logits):
+    set_data = DistillationDataset(create_seeded_dataset(set_path, cfg, shape), cfg['seed'], logits)
+    return create_dataloader(set_data, batch_size, autotune=cfg.get('autotune_loader', False),
+                             sampler=get_sampler(set_data, True, cfg['seed']))
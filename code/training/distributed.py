@@ -0,0 +1,120 @@
+import os
+import socket
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils import data
+
+"""
+    Data-parallel training: N processes each hold a replica of the model wrapped in DistributedDataParallel,
+    read their own shard of the training set and all-reduce the gradients over gloo after every backward.
+    The configured batch_size is the global batch, split evenly between the processes, so the averaged
+    gradient and the optimizer step are those of a single process run. Metrics are summed over all ranks
+    and only rank 0 writes weights and performance files.
+
+    Processes are spawned on this machine (cfg distributed_processes), or started by torchrun on one or
+    several nodes, e.g. torchrun --nnodes 2 --nproc_per_node 8 --rdzv_endpoint host:29500 test.py, in which
+    case the RANK, WORLD_SIZE and MASTER_ADDR variables it sets are used as they are.
+
+    BatchNorm statistics are computed per process, over the local part of the batch.
+"""
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def launched_by_torchrun():
+    return 'RANK' in os.environ and 'WORLD_SIZE' in os.environ
+
+
+def _run(local_rank, local_world_size, fn, cfg, backend):
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+    # the cores the job may run on are shared between the processes instead of each one using all of them
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    torch.set_num_threads(max(1, cores // local_world_size))
+    dist.init_process_group(backend)
+    try:
+        return fn(cfg)
+    finally:
+        dist.destroy_process_group()
+
+
+def _spawned(local_rank, world_size, fn, cfg, backend):
+    os.environ['RANK'] = str(local_rank)
+    os.environ['LOCAL_RANK'] = str(local_rank)
+    os.environ['WORLD_SIZE'] = str(world_size)
+    _run(local_rank, world_size, fn, cfg, backend)
+
+
+def _free_port():
+    # a port chosen by the system, so concurrent runs on one machine do not collide
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def launch(fn, cfg, num_processes, backend='gloo'):
+    if launched_by_torchrun():
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', os.environ['WORLD_SIZE']))
+        return _run(int(os.environ.get('LOCAL_RANK', 0)), local_world_size, fn, cfg, backend)
+
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    free_port = 'MASTER_PORT' not in os.environ
+    if free_port:
+        os.environ['MASTER_PORT'] = str(_free_port())
+    try:
+        mp.spawn(_spawned, args=(num_processes, fn, cfg, backend), nprocs=num_processes)
+    finally:
+        # the next launch of this process picks a new port
+        if free_port:
+            del os.environ['MASTER_PORT']
+
+
+def wrap_model(model, device):
+    if not is_distributed():
+        return model
+    device_ids = [device.index if device.index is not None else torch.cuda.current_device()] \
+        if device.type == 'cuda' else None
+    return torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids)
+
+
+class EvaluationSampler(data.Sampler):
+    # strided split of the indices, without the padding of DistributedSampler, so every sample is evaluated
+    # exactly once over all ranks
+    def __init__(self, set_data, rank=None, world_size=None):
+        self.length = len(set_data)
+        self.rank = get_rank() if rank is None else rank
+        self.world_size = get_world_size() if world_size is None else world_size
+
+    def __iter__(self):
+        return iter(range(self.rank, self.length, self.world_size))
+
+    def __len__(self):
+        return len(range(self.rank, self.length, self.world_size))
+
+
+def get_sampler(set_data, shuffle=True, seed=42):
+    if not is_distributed() or isinstance(set_data, data.IterableDataset):
+        return None
+    if shuffle:
+        return data.DistributedSampler(set_data, shuffle=True, seed=seed)
+    return EvaluationSampler(set_data)
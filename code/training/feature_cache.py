@@ -0,0 +1,185 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import torch
+from torch import nn
+from torch.utils import data
+
+from code.training.auxiliary import create_dataset, create_dataloader, get_transform
+from code.training.manifest import MANIFEST_PATH
+
+"""
+    Frozen-prefix activation cache: when pretrained_weights freezes every layer before finetune_layer, the
+    frozen part of the network gives the same output for an image in every epoch. The input of the first
+    trainable top-level module is computed once per image (per augmented variant when augmenting) and kept in
+    memory or in models/<model_name>/feature_cache, and training then only runs the trainable suffix.
+
+    The prefix runs in eval mode, so its BatchNorm layers use their running statistics instead of the
+    statistics of each batch. The suffix is checked against the full model on a probe batch, and models whose
+    forward does more than chaining their top-level modules fall back to training the full model.
+"""
+
+
+class _PrefixDone(Exception):
+    pass
+
+
+class Suffix(nn.Module):
+    # the trainable top-level modules in their forward order, flattening before the classifier as the
+    # torchvision and custom forwards do
+    def __init__(self, modules):
+        super(Suffix, self).__init__()
+        self.blocks = nn.ModuleList(modules)
+
+    def forward(self, x):
+        for block in self.blocks:
+            if x.dim() > 2 and isinstance(block, nn.Linear):
+                x = torch.flatten(x, 1)
+            x = block(x)
+        return x
+
+
+def split_frozen_prefix(model):
+    children = list(model.children())
+    for index, child in enumerate(children):
+        if any(p.requires_grad for p in child.parameters()):
+            if index == 0:
+                return None
+            return child, Suffix(children[index:])
+    return None
+
+
+def compute_prefix(model, split_module, images):
+    captured = {}
+
+    def hook(module, inputs):
+        captured['features'] = inputs[0]
+        raise _PrefixDone()
+
+    handle = split_module.register_forward_pre_hook(hook)
+    try:
+        model(images)
+    except _PrefixDone:
+        pass
+    finally:
+        handle.remove()
+    return captured['features']
+
+
+def verify_suffix(model, split_module, suffix, images):
+    model.eval()
+    with torch.no_grad():
+        expected = model(images)
+        outputs = suffix(compute_prefix(model, split_module, images))
+    return outputs.shape == expected.shape and torch.allclose(outputs, expected, rtol=1e-4, atol=1e-5)
+
+
+def _cache_key(cfg, set_path, shape, variants, augment):
+    # the augmentation settings are in the transform, also when they run on the device with batch augmentation
+    key = [torch.__version__, cfg['model_name'], cfg['finetune_layer'], str(cfg['layers']), str(shape),
+           os.path.abspath(set_path), str(variants), str(cfg['seed']), str(cfg.get('draft_decode', True)),
+           str(cfg.get('batch_augmentation', False)),
+           repr(get_transform(dict(cfg, batch_augmentation=False), shape, augment))]
+    weights_path = os.path.join(cfg.get('models_dir', 'models'), cfg['model_name'], f"{cfg['model_name']}.pkl")
+    if cfg['pretrained_model'] and os.path.exists(weights_path):
+        key.append(str(os.path.getmtime(weights_path)))
+    if os.path.exists(MANIFEST_PATH):
+        key.append(str(os.path.getmtime(MANIFEST_PATH)))
+    return hashlib.sha1(' '.join(key).encode()).hexdigest()
+
+
+def get_feature_cache_path(model_name, set_path, models_dir='models'):
+    return os.path.join(models_dir, model_name, 'feature_cache', os.path.basename(os.path.normpath(set_path)))
+
+
+def extract_features(model, split_module, loader, device, variants=1, batch_transform=None, memory_format=None):
+    # variants passes over the split: every pass draws new augmentations when the loader augments
+    model.eval()
+    features = []
+    labels = []
+    with torch.no_grad():
+        for variant in range(variants):
+            variant_features = []
+            for images, targets in loader:
+                images = images.to(device)
+                if batch_transform is not None:
+                    images = batch_transform(images)
+                if memory_format is not None:
+                    images = images.contiguous(memory_format=memory_format)
+                variant_features.append(compute_prefix(model, split_module, images).float().cpu())
+                if variant == 0:
+                    labels.append(targets)
+            features.append(torch.cat(variant_features))
+    # (N, variants, ...), variants of one image share its index
+    return torch.stack(features, dim=1), torch.cat(labels)
+
+
+class FeatureDataset(data.Dataset):
+    def __init__(self, features, labels, classes=None):
+        self.features = features
+        self.labels = labels
+        self.classes = classes
+        self.variants = features.shape[1]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        # one of the cached augmented variants, drawn from the global generator of the training process
+        variant = int(torch.randint(self.variants, ())) if self.variants > 1 else 0
+        return torch.as_tensor(np.asarray(self.features[index, variant])), int(self.labels[index])
+
+
+def load_feature_cache(cache_path, key):
+    meta_path = os.path.join(cache_path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    if meta['key'] != key:
+        return None
+    features = np.load(os.path.join(cache_path, 'features.npy'), mmap_mode='c')
+    labels = np.load(os.path.join(cache_path, 'labels.npy'))
+    return FeatureDataset(features, labels, meta['classes'])
+
+
+def write_feature_cache(cache_path, key, features, labels, classes):
+    # same temporary folder and rename as the tensor cache, a crashed write never looks complete
+    tmp_path = cache_path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, 'features.npy'), features.numpy())
+    np.save(os.path.join(tmp_path, 'labels.npy'), labels.numpy())
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'key': key, 'classes': classes, 'shape': list(features.shape)}, f)
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    os.replace(tmp_path, cache_path)
+
+
+def get_feature_dataset(cfg, model, split_module, set_path, shape, device, augment=False, batch_transform=None,
+                        memory_format=None, batch_size=64):
+    # unaugmented splits need a single pass, augmented ones keep feature_cache_variants versions of each image
+    variants = max(1, cfg.get('feature_cache_variants', 1)) if augment else 1
+    key = _cache_key(cfg, set_path, shape, variants, augment)
+    cache_path = get_feature_cache_path(cfg['model_name'], set_path, cfg.get('models_dir', 'models'))
+    if cfg.get('feature_cache') == 'disk':
+        set_data = load_feature_cache(cache_path, key)
+        if set_data is not None:
+            return set_data
+
+    # the passes must visit the images in the same order, shards included
+    set_data = create_dataset(set_path, cfg, shape, augment)
+    if hasattr(set_data, 'shuffle'):
+        set_data.shuffle = False
+    loader = create_dataloader(set_data, batch_size, shuffle=False)
+    features, labels = extract_features(model, split_module, loader, device, variants, batch_transform,
+                                        memory_format)
+    classes = getattr(set_data, 'classes', None)
+    if cfg.get('feature_cache') == 'disk':
+        write_feature_cache(cache_path, key, features, labels, classes)
+        print(f'Features of {set_path} cached in {cache_path}')
+    return FeatureDataset(features, labels, classes)
@@ -0,0 +1,95 @@
+import copy
+from collections import OrderedDict
+import torch
+from torch import nn
+from torch.fx.experimental.optimization import fuse
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torchvision.models.densenet import _Transition
+
+from code.training.custom_models import CustomResNet, CustomDenseNet, CustomSEResNet, ResidualBlock, BasicBlock, \
+    TransitionBlock
+
+"""
+    Inference-time folding: in eval mode a BatchNorm is a fixed per-channel affine, so the one following a
+    convolution is folded into its weights and bias, and the model runs one convolution instead of a convolution
+    and a normalization pass. The custom models are folded module by module, keeping their structure (the stem,
+    conv1/bn1 and conv2/bn2 of the ResidualBlocks and BasicBlocks, their shortcut and downsample convolutions),
+    and the torchvision backbones are traced and folded with torch.fx.
+
+    DenseBlocks and TransitionBlocks are pre-activation, BN-ReLU-conv, their BatchNorm has a ReLU before the
+    next convolution and cannot be folded. In a TransitionBlock the 1x1 convolution, without bias, commutes with
+    the average pooling, so the pooling runs first and the convolution on a quarter of the positions, for the
+    torchvision DenseNet transitions as well.
+
+    The ReLUs stay separate in-place modules after their folded convolutions: eager PyTorch has no fp32
+    convolution-activation kernel, compile_mode 'compile' or 'trace' fuses them on top of the folding.
+
+    The outputs of the optimized model are compared with the ones of the original on random images, and the
+    original is returned if they differ by more than tolerance, relative to the output scale.
+"""
+
+
+def _fold_sequential(sequential):
+    # the Conv2d-BatchNorm2d shortcut and downsample branches
+    return nn.Sequential(fuse_conv_bn_eval(sequential[0], sequential[1]))
+
+
+def fold_custom_model(model):
+    model.conv1 = fuse_conv_bn_eval(model.conv1, model.bn1)
+    model.bn1 = nn.Identity()
+    for module in model.modules():
+        if isinstance(module, (ResidualBlock, BasicBlock)):
+            module.conv1 = fuse_conv_bn_eval(module.conv1, module.bn1)
+            module.bn1 = nn.Identity()
+            module.conv2 = fuse_conv_bn_eval(module.conv2, module.bn2)
+            module.bn2 = nn.Identity()
+            if isinstance(getattr(module, 'shortcut', None), nn.Sequential):
+                module.shortcut = _fold_sequential(module.shortcut)
+            if getattr(module, 'downsample', None) is not None:
+                module.downsample = _fold_sequential(module.downsample)
+        elif isinstance(module, TransitionBlock):
+            module.pool_first = True
+    return model
+
+
+def _pool_first_transitions(module):
+    for name, child in module.named_children():
+        if isinstance(child, _Transition):
+            setattr(module, name, nn.Sequential(OrderedDict([('norm', child.norm), ('relu', child.relu),
+                                                             ('pool', child.pool), ('conv', child.conv)])))
+        else:
+            _pool_first_transitions(child)
+
+
+def fuse_torchvision_model(model):
+    _pool_first_transitions(model)
+    return fuse(model, inplace=True)
+
+
+def max_difference(model, optimized, shape, batch_size=2):
+    device = next(model.parameters()).device
+    images = torch.randn(batch_size, 3, *shape, device=device)
+    with torch.no_grad():
+        reference = model(images)
+        output = optimized(images)
+    return (reference - output).abs().max().item() / max(1.0, reference.abs().max().item())
+
+
+def optimize_for_inference(model, shape, tolerance=1e-3):
+    model.eval()
+    try:
+        optimized = copy.deepcopy(model)
+        if isinstance(model, (CustomResNet, CustomDenseNet, CustomSEResNet)):
+            optimized = fold_custom_model(optimized)
+        else:
+            optimized = fuse_torchvision_model(optimized)
+        optimized.eval()
+        difference = max_difference(model, optimized, shape)
+    except Exception as e:
+        print(f'Folding of {type(model).__name__} failed, running the original model: {e}')
+        return model
+
+    if difference > tolerance:
+        print(f'Folded {type(model).__name__} differs by {difference:.2e}, running the original model')
+        return model
+    return optimized
@@ -0,0 +1,195 @@
+import os
+import csv
+import json
+import hashlib
+import random
+import torchvision
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils import data
+from torchvision.datasets.folder import default_loader, IMG_EXTENSIONS
+
+"""
+    Split manifest: instead of copying the images into sets/training|validation|test, every image of the
+    original dataset is listed once in sets/manifest.csv together with its class, split, size and content
+    hash, and the datasets read the files from their original location.
+"""
+
+MANIFEST_PATH = os.path.join('sets', 'manifest.csv')
+
+FIELDS = ['path', 'class_index', 'class_name', 'split', 'size', 'mtime_ns', 'sha1']
+
+SPLITS = ['training', 'validation', 'test']
+
+SPLIT_RATIOS = [0.7, 0.2, 0.1]
+
+
+def _hash_file(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _scan_class(original_folder_path, class_name):
+    entries = []
+    with os.scandir(os.path.join(original_folder_path, class_name)) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.lower().endswith(IMG_EXTENSIONS):
+                stat = entry.stat()
+                entries.append((os.path.join(original_folder_path, class_name, entry.name), stat.st_size,
+                                stat.st_mtime_ns))
+    return sorted(entries)
+
+
+def read_manifest(manifest_path=MANIFEST_PATH):
+    with open(manifest_path, 'r', newline='') as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        row['class_index'] = int(row['class_index'])
+        row['size'] = int(row['size'])
+        row['mtime_ns'] = int(row['mtime_ns'])
+    return rows
+
+
+def manifest_exists(manifest_path=MANIFEST_PATH):
+    return os.path.exists(manifest_path)
+
+
+def write_manifest(original_folder_path, total=None, seed=42, manifest_path=MANIFEST_PATH, num_workers=16):
+    old_rows = {}
+    if os.path.exists(manifest_path):
+        old_rows = {row['path']: row for row in read_manifest(manifest_path)}
+
+    classes = sorted(entry.name for entry in os.scandir(original_folder_path) if entry.is_dir())
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        scanned = list(executor.map(lambda class_name: _scan_class(original_folder_path, class_name), classes))
+
+        # only new or modified files are hashed again
+        to_hash = []
+        for files in scanned:
+            for path, size, mtime_ns in files:
+                old = old_rows.get(path)
+                if old is None or old['size'] != size or old['mtime_ns'] != mtime_ns:
+                    to_hash.append(path)
+        hashes = dict(zip(to_hash, executor.map(_hash_file, to_hash)))
+
+    rng = random.Random(seed)
+    rows = []
+    for class_index, (class_name, files) in enumerate(zip(classes, scanned)):
+        class_rows = []
+        new_rows = []
+        for path, size, mtime_ns in files:
+            old = old_rows.get(path)
+            row = {'path': path, 'class_index': class_index, 'class_name': class_name, 'split': None, 'size': size,
+                   'mtime_ns': mtime_ns, 'sha1': hashes.get(path, old['sha1'] if old is not None else None)}
+            # files already in the manifest keep their split, even when modified, so images never move between
+            # sets; only new paths are assigned one
+            if old is not None:
+                row['split'] = old['split']
+                class_rows.append(row)
+            else:
+                new_rows.append(row)
+
+        rng.shuffle(new_rows)
+        if total is not None:
+            new_rows = new_rows[:max(0, int(total) - len(class_rows))]
+
+        # new files fill the split that is furthest below its share of the class
+        counts = [sum(1 for row in class_rows if row['split'] == split) for split in SPLITS]
+        for row in new_rows:
+            n = sum(counts) + 1
+            deficits = [ratio * n - count for ratio, count in zip(SPLIT_RATIOS, counts)]
+            index = deficits.index(max(deficits))
+            row['split'] = SPLITS[index]
+            counts[index] += 1
+            class_rows.append(row)
+
+        rows.extend(sorted(class_rows, key=lambda row: row['path']))
+
+    os.makedirs(os.path.dirname(manifest_path) or '.', exist_ok=True)
+    with open(manifest_path + '.tmp', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    print(f'Manifest with {len(rows)} images written to {manifest_path} ({len(hashes)} new or modified)')
+    return rows
+
+
+def get_classes(set_path, manifest_path=MANIFEST_PATH):
+    if manifest_exists(manifest_path):
+        rows = read_manifest(manifest_path)
+        return [name for _, name in sorted({(row['class_index'], row['class_name']) for row in rows})]
+    return sorted(entry.name for entry in os.scandir(set_path) if entry.is_dir())
+
+
+class ManifestDataset(data.Dataset):
+    def __init__(self, set_path, transform=None, manifest_path=MANIFEST_PATH, loader=default_loader):
+        split = os.path.basename(os.path.normpath(set_path))
+        rows = read_manifest(manifest_path)
+
+        self.classes = [name for _, name in sorted({(row['class_index'], row['class_name']) for row in rows})]
+        self.samples = [(row['path'], row['class_index']) for row in rows if row['split'] == split]
+        self.targets = [target for _, target in self.samples]
+        self.transform = transform
+        self.loader = loader
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        path, target = self.samples[index]
+        image = self.loader(path)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, target
+
+
+def get_source_dataset(set_path, transform=None, manifest_path=MANIFEST_PATH):
+    if manifest_exists(manifest_path):
+        return ManifestDataset(set_path, transform, manifest_path)
+    return torchvision.datasets.ImageFolder(root=set_path, transform=transform)
+
+
+def source_version(set_path, manifest_path=MANIFEST_PATH):
+    # cheap marker of the images of a split: the manifest, or the folders whose mtime changes when files are
+    # added, removed or renamed in them
+    if manifest_exists(manifest_path):
+        return str(os.stat(manifest_path).st_mtime_ns)
+    folders = [set_path] + sorted(entry.path for entry in os.scandir(set_path) if entry.is_dir())
+    return hashlib.sha1(' '.join(f'{folder}:{os.stat(folder).st_mtime_ns}' for folder in folders)
+                        .encode()).hexdigest()
+
+
+def source_fingerprint(source):
+    # the classes, files and labels of a split, with the size and mtime of every file
+    sha1 = hashlib.sha1(json.dumps(source.classes).encode())
+    for path, target in source.samples:
+        stat = os.stat(path)
+        sha1.update(f'{path}\t{target}\t{stat.st_size}\t{stat.st_mtime_ns}\n'.encode())
+    return sha1.hexdigest()
+
+
+def source_meta(source, set_path):
+    # recorded by the datasets derived from a split (tensor cache, shards) to check they are still current
+    return {'source_version': source_version(set_path), 'fingerprint': source_fingerprint(source)}
+
+
+_CURRENT = {}
+
+
+def source_is_current(meta_path, set_path, name='Dataset'):
+    # the full fingerprint is only computed when the marker has changed since the build, once per process,
+    # as create_sets rewrites the manifest without necessarily changing the split
+    key = (os.path.abspath(meta_path), os.stat(meta_path).st_mtime_ns, source_version(set_path))
+    if key not in _CURRENT:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        _CURRENT[key] = meta.get('source_version') == key[2] or \
+            meta.get('fingerprint') == source_fingerprint(get_source_dataset(set_path))
+        if not _CURRENT[key]:
+            print(f'{name} of {set_path} is out of date')
+    return _CURRENT[key]
@@ -0,0 +1,76 @@
+import torch
+
+"""
+    Micro-batching: a logical batch of batch_size samples is split into micro-batches that are run forward and
+    backward one after the other, accumulating gradients before a single optimizer step. Each micro-batch loss
+    is weighted by its share of the logical batch, so the accumulated gradient is the gradient of the mean loss
+    over the whole batch and the optimizer sees exactly the same update as with one large batch.
+
+    The micro-batch size is either set in the configuration or chosen from a memory budget: the activations
+    saved for backward are measured on a small probe batch and scaled per sample, next to the fixed cost of
+    the weights, their gradients and the optimizer states.
+
+    BatchNorm: batch statistics are computed per micro-batch, not over the logical batch, so normalization is
+    as noisy as with the micro-batch size, and the running mean and variance are updated once per micro-batch
+    (momentum is applied several times per optimizer step). Very small micro-batches (below ~16 samples) can
+    therefore degrade models with BatchNorm even though the gradient averaging itself is exact.
+"""
+
+
+def _tensor_bytes(tensor):
+    return tensor.numel() * tensor.element_size()
+
+
+def activation_bytes_per_sample(model, shape, device, amp_dtype=None, memory_format=None, probe_size=2):
+    # the tensors autograd keeps for backward, deduplicated by storage and without the weights
+    parameters = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    saved = {}
+
+    def pack(tensor):
+        key = tensor.untyped_storage().data_ptr()
+        if key not in parameters:
+            saved[key] = max(saved.get(key, 0), tensor.untyped_storage().nbytes())
+        return tensor
+
+    state = {name: value.clone() for name, value in model.state_dict().items()}
+    was_training = model.training
+    model.train()
+    images = torch.randn(probe_size, 3, *shape, device=device)
+    if memory_format is not None:
+        images = images.contiguous(memory_format=memory_format)
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            model(images)
+    model.load_state_dict(state)
+    model.train(was_training)
+    return sum(saved.values()) / probe_size
+
+
+def find_micro_batch_size(model, shape, batch_size, memory_budget_mb, device, amp_dtype=None, memory_format=None,
+                          optimizer_states=3, headroom=0.8):
+    # weights, gradients and the Adam (amsgrad) moments stay allocated for the whole step
+    parameter_bytes = sum(_tensor_bytes(p) for p in model.parameters() if p.requires_grad)
+    fixed_bytes = parameter_bytes * (2 + optimizer_states)
+    available = memory_budget_mb * 1024 * 1024 * headroom - fixed_bytes
+    per_sample = activation_bytes_per_sample(model, shape, device, amp_dtype, memory_format)
+
+    if available <= per_sample:
+        print(f'Memory budget of {memory_budget_mb} MB is too small for {type(model).__name__}, '
+              f'using micro-batches of 1')
+        return 1
+    return max(1, min(batch_size, int(available // per_sample)))
+
+
+def get_micro_batch_size(cfg, model, shape, device, amp_dtype=None, memory_format=None, batch_size=None):
+    batch_size = batch_size or cfg['batch_size']
+    micro_batch_size = cfg.get('micro_batch_size')
+    if micro_batch_size is None and cfg.get('memory_budget_mb') is not None:
+        micro_batch_size = find_micro_batch_size(model, shape, batch_size, cfg['memory_budget_mb'], device,
+                                                 amp_dtype, memory_format)
+    if micro_batch_size is None or micro_batch_size >= batch_size:
+        return None
+
+    print(f'Accumulating gradients over micro-batches of {micro_batch_size} for batches of {batch_size}')
+    if any(isinstance(module, torch.nn.modules.batchnorm._BatchNorm) for module in model.modules()):
+        print('BatchNorm statistics are computed per micro-batch')
+    return micro_batch_size
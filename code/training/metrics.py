@@ -0,0 +1,77 @@
+import numpy as np
+import torch
+import torch.distributed as dist
+
+"""
+    Streaming metrics: a running confusion matrix and loss sum kept on the training device, so batches need
+    no host synchronisation and memory does not grow with the dataset. The epoch metrics are computed from
+    the confusion matrix with the same formulas as sklearn (macro averages over the classes present in the
+    labels or predictions, ill-defined scores set to 0). In distributed runs the counts of all ranks are summed
+    before computing, so every rank reports the metrics of the whole dataset.
+"""
+
+
+class MetricsAccumulator:
+    def __init__(self, num_classes=None, device=None):
+        self.num_classes = num_classes
+        self.device = device
+        self.confusion = None
+        self.loss_sum = None
+        self.total = 0
+
+    def _allocate(self, num_classes, device):
+        self.num_classes = num_classes
+        self.confusion = torch.zeros(num_classes * num_classes, dtype=torch.int64, device=device)
+        self.loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+
+    def update(self, loss, outputs, labels):
+        if self.confusion is None:
+            self._allocate(self.num_classes or outputs.size(1), self.device or outputs.device)
+
+        preds = outputs.detach().argmax(dim=1)
+        self.confusion += torch.bincount(labels * self.num_classes + preds, minlength=self.num_classes ** 2)
+        self.loss_sum += loss.detach().double() * labels.size(0)
+        self.total += labels.size(0)
+
+    def all_reduce(self):
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+        # a rank without batches still takes part, with an empty confusion matrix of the common size
+        num_classes = torch.tensor([self.num_classes or 0], dtype=torch.int64)
+        dist.all_reduce(num_classes, op=dist.ReduceOp.MAX)
+        if self.confusion is None:
+            self._allocate(int(num_classes.item()), self.device or torch.device('cpu'))
+        total = torch.tensor([self.total], dtype=torch.int64, device=self.confusion.device)
+        dist.all_reduce(self.confusion)
+        dist.all_reduce(self.loss_sum)
+        dist.all_reduce(total)
+        self.total = int(total.item())
+
+    def compute(self):
+        # the only device to host copy of the epoch
+        confusion = self.confusion.view(self.num_classes, self.num_classes).cpu().numpy()
+        loss = float(self.loss_sum.item()) / self.total
+
+        # as sklearn, only the classes seen in the labels or in the predictions are reported
+        present = (confusion.sum(axis=0) + confusion.sum(axis=1)) > 0
+        confusion = confusion[present][:, present]
+
+        tp_sum = np.diag(confusion).astype(np.float64)
+        pred_sum = confusion.sum(axis=0).astype(np.float64)
+        true_sum = confusion.sum(axis=1).astype(np.float64)
+
+        precision = np.divide(tp_sum, pred_sum, out=np.zeros_like(tp_sum), where=pred_sum != 0)
+        recall = np.divide(tp_sum, true_sum, out=np.zeros_like(tp_sum), where=true_sum != 0)
+        denominator = true_sum + pred_sum
+        f1 = np.divide(2 * tp_sum, denominator, out=np.zeros_like(tp_sum), where=denominator != 0)
+
+        correct = int(np.trace(confusion))
+        return {
+            'loss': loss,
+            'accuracy': correct / self.total,
+            'f1': float(np.average(f1)),
+            'precision': float(np.average(precision)),
+            'recall': float(np.average(recall)),
+            'confusion_matrix': confusion,
+            'miss_classified': self.total - correct,
+        }
@@ -3,7 +3,10 @@ from torch import nn
 from torchvision.models import resnet18, resnet50, resnet101, densenet121, vgg16, inception_v3, efficientnet_b0
 import os
 
+from code.training.compilation import compile_model
 from code.training.custom_models import CustomResNet, CustomDenseNet, CustomSEResNet, BasicBlock
+from code.training.pruning import load_architecture, set_architecture
+from code.training.fusion import optimize_for_inference
 
 
 def get_resnet(model_name, pretrained_weights=False):
@@ -79,7 +82,8 @@ def get_efficientnet(model_name, pretrained_weights=False):
 
 
 def get_model(model_name: str, pretrained_weights, finetune_layer, pretrained_model, num_classes,
-              layers=None, growth_rate=32):
+              layers=None, growth_rate=32, compile_mode=None, device=torch.device('cpu'), memory_efficient=None, models_dir='models',
+              optimize=False, memory_format=None):
     if model_name.startswith('resnet'):
         model = get_resnet(model_name, pretrained_weights)
         shape = (224, 224)
@@ -99,7 +103,7 @@ def get_model(model_name: str, pretrained_weights, finetune_layer, pretrained_mo
         model = CustomResNet(num_classes, layers)
         shape = (50, 50)
     elif model_name.startswith('custom_densenet'):
-        model = CustomDenseNet(num_classes, growth_rate, layers)
+        model = CustomDenseNet(num_classes, growth_rate, layers, memory_efficient)
         shape = (50, 50)
     elif model_name.startswith('custom_senet'):
         model = CustomSEResNet(BasicBlock, layers, num_classes)
@@ -119,6 +123,12 @@ def get_model(model_name: str, pretrained_weights, finetune_layer, pretrained_mo
     elif model_name.startswith('vgg') or model_name.startswith('efficientnet'):
         model.classifier[-1] = nn.Linear(model.classifier[-1].in_features, num_classes)
 
+    # pruned custom models are rebuilt with the channel widths saved next to their weights, before freezing,
+    # so the rebuilt layers are frozen too
+    architecture = load_architecture(model_name, models_dir)
+    if architecture is not None:
+        set_architecture(model, architecture)
+
     if pretrained_weights:
         found_start_layer = False
         for name, param in model.named_parameters():
@@ -130,11 +140,22 @@ def get_model(model_name: str, pretrained_weights, finetune_layer, pretrained_mo
                 param.requires_grad = False
 
     if pretrained_model:
-        if os.path.exists(os.path.join('models', model_name, f'{model_name}.pkl')):
-            model.load_state_dict(torch.load(os.path.join('models', model_name, f'{model_name}.pkl')))
+        if os.path.exists(os.path.join(models_dir, model_name, f'{model_name}.pkl')):
+            model.load_state_dict(torch.load(os.path.join(models_dir, model_name, f'{model_name}.pkl')))
             print('Weights loaded')
         else:
             print('Error in loading weights')
+
+    # BatchNorm folded into the convolutions, for inference only
+    if optimize:
+        model = optimize_for_inference(model, shape)
+
+    # optionally compiled (torch.compile) or traced (TorchScript) for inference, in the memory format it runs in
+    if compile_mode:
+        model.to(device, memory_format=memory_format)
+        weights_path = os.path.join(models_dir, model_name, f'{model_name}.pkl') if pretrained_model else None
+        model = compile_model(model, shape, compile_mode, device, weights_path=weights_path,
+                              memory_format=memory_format, optimize=optimize)
     return model, shape
 
 
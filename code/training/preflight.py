@@ -0,0 +1,234 @@
+import os
+import time
+import numpy as np
+import torch
+from torch import nn
+import matplotlib.pyplot as plt
+
+from code.training.models import get_model
+from code.training.auxiliary import create_sets, get_dataloader, get_device, get_amp_dtype, get_memory_format
+from code.training.augmentation import BatchAugmentation
+from code.training.manifest import get_classes
+from code.training.memory import activation_bytes_per_sample
+from code.utils.configuration import create_configuration_file
+
+"""
+    Pre-flight: before a long run, the largest batch size that fits in a memory budget is found by doubling
+    then bisecting, timing a few training steps at every candidate, and the batch size with the best
+    throughput is kept. A learning rate range test then trains for a short number of steps with a learning rate
+    growing exponentially from start_lr to end_lr, and the recommended learning rate is a tenth of the one with
+    the lowest smoothed loss. Both are written into the configuration file.
+
+    On GPU the peak allocated memory of a step is measured, and out of memory errors mark a batch size as too
+    large. On CPU the step memory is the weights, gradients and optimizer states plus the activations saved
+    for backward, measured once per sample on a small probe, so batch sizes over the budget are never run, and
+    the default budget is the memory currently available on the machine.
+"""
+
+
+def available_memory_mb(device):
+    if device.type == 'cuda':
+        return torch.cuda.get_device_properties(device).total_memory / 1024 / 1024
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+
+def _is_out_of_memory(e):
+    return isinstance(e, torch.cuda.OutOfMemoryError) or 'out of memory' in str(e)
+
+
+def _training_step(model, optimizer, criterion, images, labels, device, amp_dtype=None):
+    optimizer.zero_grad()
+    with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+        loss = criterion(model(images), labels)
+    loss.backward()
+    optimizer.step()
+    return loss
+
+
+def estimate_memory_mb(model, batch_size, sample_bytes):
+    # weights, gradients and the Adam (amsgrad) moments, as in memory.find_micro_batch_size
+    parameter_bytes = sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad)
+    return (parameter_bytes * 5 + sample_bytes * batch_size) / 1024 / 1024
+
+
+def measure_batch_size(model, shape, num_classes, batch_size, device, amp_dtype=None, memory_format=None, steps=3,
+                       sample_bytes=None):
+    # one warm-up step and steps timed ones on random data, returns (images per second, step memory in MB)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-7, amsgrad=True)
+    criterion = nn.CrossEntropyLoss()
+    images = torch.randn(batch_size, 3, *shape, device=device)
+    if memory_format is not None:
+        images = images.contiguous(memory_format=memory_format)
+    labels = torch.randint(num_classes, (batch_size,), device=device)
+
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+    model.train()
+    _training_step(model, optimizer, criterion, images, labels, device, amp_dtype)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        _training_step(model, optimizer, criterion, images, labels, device, amp_dtype)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    images_per_second = steps * batch_size / (time.perf_counter() - start)
+
+    if device.type == 'cuda':
+        return images_per_second, torch.cuda.max_memory_allocated(device) / 1024 / 1024
+    if sample_bytes is None:
+        sample_bytes = activation_bytes_per_sample(model, shape, device, amp_dtype, memory_format)
+    return images_per_second, estimate_memory_mb(model, batch_size, sample_bytes)
+
+
+def find_batch_size(model, shape, num_classes, device, memory_budget_mb, amp_dtype=None, memory_format=None,
+                    max_batch_size=1024, headroom=0.9):
+    state = {name: value.clone() for name, value in model.state_dict().items()}
+    results = {}
+    # on CPU the memory of a batch size is estimated from the activations of one small probe, and only the
+    # batch sizes within the budget are timed
+    sample_bytes = activation_bytes_per_sample(model, shape, device, amp_dtype, memory_format) \
+        if device.type == 'cpu' else None
+
+    def fits(batch_size):
+        if sample_bytes is not None and estimate_memory_mb(model, batch_size, sample_bytes) > \
+                memory_budget_mb * headroom:
+            print(f'Batch size {batch_size}: {estimate_memory_mb(model, batch_size, sample_bytes):.0f} MB, '
+                  f'over budget')
+            return False
+        try:
+            images_per_second, memory_mb = measure_batch_size(model, shape, num_classes, batch_size, device,
+                                                              amp_dtype, memory_format, sample_bytes=sample_bytes)
+        except RuntimeError as e:
+            if not _is_out_of_memory(e):
+                raise
+            if device.type == 'cuda':
+                torch.cuda.empty_cache()
+            print(f'Batch size {batch_size}: out of memory')
+            return False
+        fit = memory_mb <= memory_budget_mb * headroom
+        print(f'Batch size {batch_size}: {images_per_second:.1f} images/s, {memory_mb:.0f} MB'
+              + ('' if fit else ', over budget'))
+        if fit:
+            results[batch_size] = images_per_second
+        return fit
+
+    # doubling up to the first batch size that does not fit, then bisecting to 1/8 of the largest one that does
+    low, high = 0, None
+    batch_size = 1
+    while batch_size <= max_batch_size:
+        if not fits(batch_size):
+            high = batch_size
+            break
+        low = batch_size
+        batch_size *= 2
+    if high is None and low < max_batch_size and fits(max_batch_size):
+        low = max_batch_size
+    while high is not None and high - low > max(1, low // 8):
+        middle = (low + high) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle
+
+    model.load_state_dict(state)
+    if not results:
+        print(f'No batch size fits in {memory_budget_mb:.0f} MB, using 1')
+        return 1, results
+    # the largest batch sizes are not always the fastest ones, ties go to the larger batch
+    best = max(results, key=lambda size: (round(results[size] / max(results.values()), 2), size))
+    return best, results
+
+
+def _repeat(loader):
+    # a new pass over the loader each time it is exhausted, itertools.cycle would keep every batch in memory
+    while True:
+        yield from loader
+
+
+def lr_range_test(model, loader, device, start_lr=1e-7, end_lr=1.0, num_steps=100, batch_transform=None,
+                  amp_dtype=None, memory_format=None, smoothing=0.98, divergence=4.0):
+    state = {name: value.clone() for name, value in model.state_dict().items()}
+    optimizer = torch.optim.Adam(model.parameters(), lr=start_lr, amsgrad=True)
+    criterion = nn.CrossEntropyLoss()
+    gamma = (end_lr / start_lr) ** (1 / max(1, num_steps - 1))
+
+    model.train()
+    learning_rates = []
+    losses = []
+    average = 0.0
+    best = float('inf')
+    batches = _repeat(loader)
+    for step in range(num_steps):
+        images, labels = next(batches)
+        images, labels = images.to(device), labels.to(device)
+        if batch_transform is not None:
+            images = batch_transform(images)
+        if memory_format is not None:
+            images = images.contiguous(memory_format=memory_format)
+        loss = _training_step(model, optimizer, criterion, images, labels, device, amp_dtype)
+
+        # exponential moving average with bias correction, the raw loss is too noisy to compare
+        average = smoothing * average + (1 - smoothing) * loss.item()
+        smoothed = average / (1 - smoothing ** (step + 1))
+        learning_rates.append(optimizer.param_groups[0]['lr'])
+        losses.append(smoothed)
+        if not np.isfinite(smoothed) or smoothed > divergence * best:
+            break
+        best = min(best, smoothed)
+        for group in optimizer.param_groups:
+            group['lr'] *= gamma
+
+    model.load_state_dict(state)
+    return learning_rates, losses
+
+
+def suggest_learning_rate(learning_rates, losses):
+    return learning_rates[int(np.nanargmin(losses))] / 10
+
+
+def preflight(cfg, config_path='config.yaml', memory_budget_mb=None, max_batch_size=None, lr_steps=100):
+    model_name = cfg['model_name']
+    models_dir = cfg.get('models_dir', 'models')
+    if not os.path.exists('sets'):
+        create_sets(cfg['dataset_path'])
+    os.makedirs(os.path.join(models_dir, model_name, 'performance'), exist_ok=True)
+
+    device = get_device(cfg['seed'])
+    torch.manual_seed(cfg['seed'])
+    num_classes = len(get_classes(os.path.join('sets', 'training')))
+    model, shape = get_model(model_name, cfg['pretrained_weights'], cfg['finetune_layer'], cfg['pretrained_model'],
+                             num_classes, cfg['layers'], memory_efficient=cfg.get('memory_efficient'),
+                             models_dir=models_dir)
+    memory_format = get_memory_format(cfg)
+    model.to(device, memory_format=memory_format)
+    amp_dtype = get_amp_dtype(cfg)
+
+    # batches larger than the training set are never full
+    training_size = len(get_dataloader(os.path.join('sets', 'training'), cfg, shape, 1, augment=True).dataset)
+    max_batch_size = min(max_batch_size or training_size, training_size)
+    memory_budget_mb = memory_budget_mb or cfg.get('memory_budget_mb') or available_memory_mb(device)
+    print(f'Searching the batch size of {model_name} for a budget of {memory_budget_mb:.0f} MB')
+    batch_size, throughput = find_batch_size(model, shape, num_classes, device, memory_budget_mb, amp_dtype,
+                                             memory_format, max_batch_size)
+
+    train_loader = get_dataloader(os.path.join('sets', 'training'), cfg, shape, batch_size, augment=True)
+    batch_transform = BatchAugmentation(cfg, device) if cfg.get('batch_augmentation', False) else None
+    learning_rates, losses = lr_range_test(model, train_loader, device, num_steps=lr_steps,
+                                           batch_transform=batch_transform, amp_dtype=amp_dtype,
+                                           memory_format=memory_format)
+    learning_rate = suggest_learning_rate(learning_rates, losses)
+
+    plt.figure(figsize=(10, 6))
+    plt.semilogx(learning_rates, losses)
+    plt.axvline(learning_rate, color='r', linestyle='--')
+    plt.xlabel('Learning rate')
+    plt.ylabel('Smoothed training loss')
+    plt.savefig(os.path.join(models_dir, model_name, 'performance', 'lr_range_test.png'))
+    plt.close()
+
+    print(f'Recommended batch size {batch_size}, learning rate {learning_rate:.2e}')
+    create_configuration_file(**dict(cfg, batch_size=batch_size, learning_rate=learning_rate,
+                                     config_path=config_path))
+    return {'batch_size': batch_size, 'learning_rate': learning_rate, 'throughput': throughput}
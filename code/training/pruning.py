@@ -0,0 +1,205 @@
+import os
+import csv
+import json
+import time
+import torch
+from torch import nn
+
+from code.training.custom_models import ResidualBlock, BasicBlock
+
+"""
+    Structured channel pruning of CustomResNet and CustomSEResNet: the channels between conv1 and conv2 of every
+    ResidualBlock and BasicBlock are ranked by the absolute BatchNorm scale of bn1 ('bn') or by the L1 norm of
+    the conv1 filters ('l1'), and the weakest ones are removed from conv1, bn1 and conv2. The block outputs keep
+    their width, so shortcuts, downsample convolutions and SEBlocks are unchanged, and the result is a smaller
+    dense model running the usual kernels.
+
+    The pruned widths are saved in <model_name>_arch.json next to the weights, and get_model rebuilds the
+    pruned model from it. prune_model alternates pruning and fine-tuning and reports FLOPs, parameters,
+    latency and test accuracy after every step.
+"""
+
+
+def get_architecture_path(model_name, models_dir='models'):
+    return os.path.join(models_dir, model_name, f'{model_name}_arch.json')
+
+
+def prunable_blocks(model):
+    return [module for module in model.modules() if isinstance(module, (ResidualBlock, BasicBlock))]
+
+
+def _select_conv(conv, out_channels=None, in_channels=None):
+    weight = conv.weight.detach()
+    if out_channels is not None:
+        weight = weight[out_channels]
+    if in_channels is not None:
+        weight = weight[:, in_channels]
+    pruned = nn.Conv2d(weight.size(1), weight.size(0), conv.kernel_size, conv.stride, conv.padding,
+                       conv.dilation, bias=conv.bias is not None).to(weight.device)
+    pruned.weight.data.copy_(weight)
+    if conv.bias is not None:
+        pruned.bias.data.copy_(conv.bias.detach() if out_channels is None else conv.bias.detach()[out_channels])
+    return pruned
+
+
+def _select_bn(bn, channels):
+    pruned = nn.BatchNorm2d(len(channels), bn.eps, bn.momentum).to(bn.weight.device)
+    pruned.weight.data.copy_(bn.weight.detach()[channels])
+    pruned.bias.data.copy_(bn.bias.detach()[channels])
+    pruned.running_mean.copy_(bn.running_mean[channels])
+    pruned.running_var.copy_(bn.running_var[channels])
+    pruned.num_batches_tracked.copy_(bn.num_batches_tracked)
+    return pruned
+
+
+def prune_block(block, channels):
+    block.conv1 = _select_conv(block.conv1, out_channels=channels)
+    block.bn1 = _select_bn(block.bn1, channels)
+    block.conv2 = _select_conv(block.conv2, in_channels=channels)
+
+
+def channel_importance(block, criterion='bn'):
+    if criterion == 'bn':
+        return block.bn1.weight.detach().abs()
+    return block.conv1.weight.detach().abs().sum(dim=(1, 2, 3))
+
+
+def prune_channels(model, amount, criterion='bn'):
+    # amount of the internal channels of every block, at least one channel is kept
+    for block in prunable_blocks(model):
+        importance = channel_importance(block, criterion)
+        keep = max(1, int(round(importance.numel() * (1 - amount))))
+        channels = importance.argsort(descending=True)[:keep].sort().values
+        prune_block(block, channels)
+    return model
+
+
+def get_architecture(model):
+    return {'widths': [block.conv1.out_channels for block in prunable_blocks(model)]}
+
+
+def set_architecture(model, architecture):
+    # modules of the pruned widths, their weights are then loaded from the state dict
+    for block, width in zip(prunable_blocks(model), architecture['widths']):
+        if width != block.conv1.out_channels:
+            prune_block(block, torch.arange(width))
+    return model
+
+
+def save_architecture(model, model_name, models_dir='models'):
+    with open(get_architecture_path(model_name, models_dir), 'w') as f:
+        json.dump(get_architecture(model), f)
+
+
+def load_architecture(model_name, models_dir='models'):
+    architecture_path = get_architecture_path(model_name, models_dir)
+    if not os.path.exists(architecture_path):
+        return None
+    with open(architecture_path, 'r') as f:
+        return json.load(f)
+
+
+def count_flops(model, shape):
+    # multiply-accumulates of the convolutions and linear layers for one image
+    flops = []
+
+    def hook(module, inputs, output):
+        if isinstance(module, nn.Conv2d):
+            kernel = module.kernel_size[0] * module.kernel_size[1] * module.in_channels // module.groups
+            flops.append(output[0].numel() * kernel)
+        else:
+            flops.append(module.in_features * module.out_features)
+
+    handles = [module.register_forward_hook(hook) for module in model.modules()
+               if isinstance(module, (nn.Conv2d, nn.Linear))]
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        model(torch.randn(1, 3, *shape, device=next(model.parameters()).device))
+    model.train(was_training)
+    for handle in handles:
+        handle.remove()
+    return sum(flops)
+
+
+def measure_latency(model, shape, batch_size=1, steps=20, warmup=3):
+    images = torch.randn(batch_size, 3, *shape, device=next(model.parameters()).device)
+    model.eval()
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(images)
+        start = time.perf_counter()
+        for _ in range(steps):
+            model(images)
+    return (time.perf_counter() - start) / steps
+
+
+def _report_row(step, model, shape, results):
+    return {'step': step, 'widths': ' '.join(str(width) for width in get_architecture(model)['widths']),
+            'mflops': count_flops(model, shape) / 1e6,
+            'parameters': sum(p.numel() for p in model.parameters()),
+            'latency_b1_ms': 1000 * measure_latency(model, shape, 1),
+            'latency_b32_ms': 1000 * measure_latency(model, shape, 32, steps=5),
+            'test_accuracy': results['accuracy'], 'test_f1': results['f1']}
+
+
+def _evaluate(cfg, model, shape):
+    # the test set metrics of test_model, without writing the results of the unpruned model again
+    from code.training.auxiliary import get_dataloader, get_device
+    from code.training.augmentation import BatchAugmentation
+    from code.training.train_model import evaluate
+
+    device = get_device(cfg['seed'])
+    test_loader = get_dataloader(os.path.join('sets', 'test'), cfg, shape, 64, augment=True)
+    test_transform = BatchAugmentation(cfg, device) if cfg.get('batch_augmentation', False) else None
+    results = evaluate(test_loader, model.to(device), nn.CrossEntropyLoss(), device, test_transform)
+    model.cpu()
+    return results
+
+
+def prune_model(cfg, amount=0.2, steps=3, finetune_epochs=10, criterion='bn', pruned_name=None):
+    # iterative schedule: every step removes amount of the remaining internal channels, then fine-tunes
+    from code.training.models import get_model
+    from code.training.manifest import get_classes
+    from code.training.train_model import train_model, test_model
+
+    model_name = cfg['model_name']
+    models_dir = cfg.get('models_dir', 'models')
+    pruned_name = pruned_name or f'{model_name}_pruned'
+    if not model_name.startswith(('custom_resnet', 'custom_senet')):
+        print(f'Channel pruning supports the custom ResNet and SE-ResNet models, not {model_name}')
+        return None
+
+    num_classes = len(get_classes(os.path.join('sets', 'test')))
+    model, shape = get_model(model_name, False, cfg['finetune_layer'], True, num_classes, cfg['layers'],
+                             models_dir=models_dir)
+    rows = [_report_row(0, model, shape, _evaluate(cfg, model, shape))]
+
+    pruned_dir = os.path.join(models_dir, pruned_name)
+    os.makedirs(os.path.join(pruned_dir, 'performance'), exist_ok=True)
+    # plain fine-tuning of the pruned weights, at the full shape and without a CIFAR pre-training, teacher or
+    # int8 model
+    pruned_cfg = dict(cfg, model_name=pruned_name, pretrained_weights=False, pretrained_model=True,
+                      epochs=finetune_epochs, resume=False, qat_epochs=0, feature_cache=None, pretrain_CIFAR=False,
+                      teacher_model=None, quantized=False, resize_stages=None)
+    for step in range(1, steps + 1):
+        prune_channels(model, amount, criterion)
+        save_architecture(model, pruned_name, models_dir)
+        torch.save(model.state_dict(), os.path.join(pruned_dir, f'{pruned_name}.pkl'))
+        print(f"Step {step}: internal widths {get_architecture(model)['widths']}, fine-tuning")
+        train_model(pruned_cfg)
+
+        model, shape = get_model(pruned_name, False, cfg['finetune_layer'], True, num_classes, cfg['layers'],
+                                 models_dir=models_dir)
+        rows.append(_report_row(step, model, shape, test_model(pruned_cfg)))
+
+    report_path = os.path.join(pruned_dir, 'performance', 'pruning_report.csv')
+    with open(report_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(' | '.join(rows[0].keys()))
+    for row in rows:
+        print(' | '.join('{:.4g}'.format(v) if isinstance(v, float) else str(v) for v in row.values()))
+    print(f'Report written to {report_path}')
+    return rows
@@ -0,0 +1,112 @@
+import os
+import copy
+import json
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping, get_default_qat_qconfig_mapping, disable_observer
+from torch.ao.quantization.quantize_fx import prepare_fx, prepare_qat_fx, convert_fx
+from torch.ao.nn.intrinsic.qat import freeze_bn_stats
+
+from code.training.models import get_model
+from code.training.auxiliary import get_dataloader
+from code.training.augmentation import BatchAugmentation
+from code.training.manifest import get_classes
+
+"""
+    Post-training static int8 quantization: the trained fp32 model is traced with FX, observers are inserted
+    on weights and activations, calibrated on calibration_images images of sets/validation, and the model is
+    converted to int8 CPU kernels (x86 for servers, qnnpack for ARM boxes). The result is saved as TorchScript
+    next to the fp32 weights, models/<model_name>/<model_name>_int8.pt, with the input shape and backend it
+    needs, and test_model evaluates it when cfg quantized is set.
+
+    The int8 model takes the same normalized fp32 images as the fp32 one and returns fp32 logits.
+
+    Quantization-aware training (cfg qat_epochs) fine-tunes the model, usually from its trained weights, with
+    conv-bn(-relu) fused and fake quantization on weights and activations, so it learns to absorb the rounding
+    of int8. For the last quarter of the epochs the observers and the BatchNorm statistics are frozen. The best
+    fake-quantized weights are kept in <model_name>_qat.pkl and converted to the same int8 TorchScript file.
+"""
+
+
+def get_quantized_path(model_name, models_dir='models'):
+    return os.path.join(models_dir, model_name, f'{model_name}_int8.pt')
+
+
+def calibrate(prepared, loader, num_images=256, batch_transform=None):
+    count = 0
+    with torch.no_grad():
+        for images, _ in loader:
+            if batch_transform is not None:
+                images = batch_transform(images)
+            prepared(images)
+            count += images.size(0)
+            if count >= num_images:
+                break
+    return count
+
+
+def quantize(model, shape, loader, num_images=256, backend='x86', batch_transform=None):
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), (torch.randn(1, 3, *shape),))
+    count = calibrate(prepared, loader, num_images, batch_transform)
+    print(f'Calibrated on {count} images')
+    return convert_fx(prepared)
+
+
+def prepare_qat(model, shape, backend='x86'):
+    torch.backends.quantized.engine = backend
+    model.train()
+    example = (torch.randn(2, 3, *shape, device=next(model.parameters()).device),)
+    return prepare_qat_fx(model, get_default_qat_qconfig_mapping(backend), example)
+
+
+def freeze_qat(model, epoch, epochs):
+    # the quantization ranges and the batch statistics settle before the last epochs
+    if epochs > 1 and epoch >= epochs - max(1, epochs // 4):
+        model.apply(disable_observer)
+        model.apply(freeze_bn_stats)
+
+
+def convert_qat(model):
+    return convert_fx(copy.deepcopy(model).cpu().eval())
+
+
+def save_quantized_model(quantized, shape, path, backend='x86'):
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized, torch.randn(1, 3, *shape))
+    torch.jit.save(traced, path, _extra_files={'meta': json.dumps({'shape': list(shape), 'backend': backend})})
+
+
+def load_quantized_model(path):
+    extra_files = {'meta': ''}
+    model = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+    meta = json.loads(extra_files['meta'])
+    # the kernels of the backend the model was quantized for
+    torch.backends.quantized.engine = meta['backend']
+    model.eval()
+    return model, tuple(meta['shape'])
+
+
+def quantize_model(cfg):
+    model_name = cfg['model_name']
+    models_dir = cfg.get('models_dir', 'models')
+    weights_path = os.path.join(models_dir, model_name, f'{model_name}.pkl')
+    if not os.path.exists(weights_path):
+        print(f'Error in loading weights, {weights_path} is needed for quantization')
+        return None
+
+    # the standard DenseNet stages trace with FX, the memory-efficient ones hold the same weights
+    num_classes = len(get_classes(os.path.join('sets', 'test')))
+    model, shape = get_model(model_name, False, cfg['finetune_layer'], True, num_classes, cfg['layers'],
+                             models_dir=models_dir)
+
+    backend = cfg.get('quantization_backend', 'x86')
+    loader = get_dataloader(os.path.join('sets', 'validation'), cfg, shape, 64, shuffle=False)
+    batch_transform = BatchAugmentation(cfg, torch.device('cpu'), augment=False) \
+        if cfg.get('batch_augmentation', False) else None
+    quantized = quantize(model, shape, loader, cfg.get('calibration_images', 256), backend, batch_transform)
+
+    quantized_path = get_quantized_path(model_name, models_dir)
+    save_quantized_model(quantized, shape, quantized_path, backend)
+    print(f'Quantized model saved in {quantized_path}')
+    return quantized_path
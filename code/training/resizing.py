@@ -0,0 +1,37 @@
+import math
+
+"""
+    Progressive resizing: resize_stages lists [scale, epochs] or [scale, epochs, batch_multiplier] stages that
+    train at a fraction of the input shape of the model before the remaining epochs run at the full shape, e.g.
+    [[0.5, 10], [0.75, 10]]. Smaller images cost less per sample, so a stage trains with batches batch_multiplier
+    times larger (by default the inverse of the area ratio, which keeps the activation memory about constant)
+    and a learning rate scaled by its square root, the usual rule for Adam.
+
+    Validation always runs at the full shape, so the best validation loss and the saved weights are comparable
+    across stages. Every stage starts with its own learning rate and a fresh plateau scheduler, and early
+    stopping only counts epochs of the last, full-size stage.
+"""
+
+
+def _stage_shape(shape, scale):
+    # multiples of 8 keep the feature maps of strided convolutions aligned
+    return tuple(max(8, int(round(size * scale / 8)) * 8) for size in shape)
+
+
+def get_resize_stages(resize_stages, shape, batch_size, epochs):
+    stages = []
+    start = 0
+    for stage in resize_stages or []:
+        scale, stage_epochs = stage[0], int(stage[1])
+        batch_multiplier = stage[2] if len(stage) > 2 else max(1, round(1 / scale ** 2))
+        if start + stage_epochs >= epochs:
+            break
+        stages.append({'start': start, 'shape': _stage_shape(shape, scale),
+                       'batch_size': int(batch_size * batch_multiplier), 'lr_factor': math.sqrt(batch_multiplier)})
+        start += stage_epochs
+    stages.append({'start': start, 'shape': tuple(shape), 'batch_size': batch_size, 'lr_factor': 1.0})
+    return stages
+
+
+def get_stage(stages, epoch):
+    return [stage for stage in stages if stage['start'] <= epoch][-1]
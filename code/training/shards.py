@@ -0,0 +1,203 @@
+import os
+import io
+import json
+import hashlib
+import random
+import math
+import tarfile
+import torch
+import torch.distributed as dist
+from torch.utils import data
+
+from code.training.decoding import draft_loader
+from code.training.manifest import get_source_dataset, source_meta, source_is_current
+
+"""
+    Sharded archives: the encoded images of a split are packed into large tar shards read front to back,
+    turning the random small-file reads of ImageFolder into a few long sequential reads.
+
+    In distributed runs every process reads only its own shards, every world_size-th one of the epoch order,
+    which are split across its DataLoader workers. The processes all yield ceil(count / world_size) records,
+    so they run the same number of batches: the ones whose shards hold more drop the last records of the
+    epoch, the others repeat their first ones. The shard order is reshuffled every epoch, so the records
+    dropped change from one epoch to the next.
+"""
+
+SHARDS_ROOT = 'sets_shards'
+
+
+def get_shards_path(set_path, shards_root=SHARDS_ROOT):
+    # as for the tensor cache, the hash of the full path keeps the shards of splits sharing a basename apart
+    set_path = os.path.abspath(set_path)
+    path_hash = hashlib.sha1(set_path.encode()).hexdigest()[:10]
+    return os.path.join(shards_root, f'{os.path.basename(set_path)}_{path_hash}')
+
+
+def shards_exist(set_path, shards_root=SHARDS_ROOT):
+    index_path = os.path.join(get_shards_path(set_path, shards_root), 'index.json')
+    if not os.path.exists(index_path):
+        return False
+    return source_is_current(index_path, set_path, 'Shards')
+
+
+def _add_member(tar, name, payload):
+    info = tarfile.TarInfo(name)
+    info.size = len(payload)
+    tar.addfile(info, io.BytesIO(payload))
+
+
+def export_shards(set_path, shards_root=SHARDS_ROOT, shard_size_mb=256, seed=42):
+    source = get_source_dataset(set_path)
+    shards_path = get_shards_path(set_path, shards_root)
+    os.makedirs(shards_path, exist_ok=True)
+
+    # samples are shuffled once at export, so neighbouring records in a shard are not all one class
+    samples = list(source.samples)
+    random.Random(seed).shuffle(samples)
+
+    shards = []
+    tar = None
+    shard_bytes = 0
+    for key, (path, target) in enumerate(samples):
+        if tar is None or shard_bytes >= shard_size_mb * 1024 * 1024:
+            if tar is not None:
+                tar.close()
+            shards.append({'name': f'shard-{len(shards):05d}.tar', 'count': 0})
+            tar = tarfile.open(os.path.join(shards_path, shards[-1]['name']), 'w')
+            shard_bytes = 0
+
+        with open(path, 'rb') as f:
+            payload = f.read()
+        extension = os.path.splitext(path)[1].lower()
+        _add_member(tar, f'{key:08d}{extension}', payload)
+        _add_member(tar, f'{key:08d}.cls', str(target).encode())
+        shards[-1]['count'] += 1
+        shard_bytes += len(payload)
+
+    if tar is not None:
+        tar.close()
+
+    with open(os.path.join(shards_path, 'index.json'), 'w') as f:
+        json.dump(dict({'classes': source.classes, 'count': len(samples), 'shards': shards},
+                       **source_meta(source, set_path)), f)
+
+    print(f'{len(samples)} images of {set_path} packed into {len(shards)} shards in {shards_path}')
+    return shards_path
+
+
+def export_all_shards(sets_folder='sets', shards_root=SHARDS_ROOT, shard_size_mb=256):
+    for split in ['training', 'validation', 'test']:
+        export_shards(os.path.join(sets_folder, split), shards_root, shard_size_mb)
+
+
+class ShardDataset(data.IterableDataset):
+    def __init__(self, set_path, transform=None, shards_root=SHARDS_ROOT, shuffle=True, buffer_size=1000, seed=42):
+        self.shards_path = get_shards_path(set_path, shards_root)
+        with open(os.path.join(self.shards_path, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.classes = index['classes']
+        self.shards = index['shards']
+        self.count = index['count']
+        self.transform = transform
+        self.loader = draft_loader
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        # in shared memory, so the persistent DataLoader workers see the epoch set by the training process
+        self.epoch = torch.zeros((), dtype=torch.long).share_memory_()
+        # read in the training process, the DataLoader workers are not part of the process group
+        self.rank, self.world_size = self._process()
+
+    def set_epoch(self, epoch):
+        self.epoch.fill_(epoch)
+        self.rank, self.world_size = self._process()
+
+    def _process(self):
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+        return 0, 1
+
+    def __len__(self):
+        return math.ceil(self.count / self.world_size)
+
+    def _epoch_shards(self, epoch):
+        # the same order in every process
+        shards = list(self.shards)
+        if self.shuffle:
+            random.Random(self.seed + epoch).shuffle(shards)
+        return shards
+
+    def _read_shard(self, name):
+        sample = {}
+        with tarfile.open(os.path.join(self.shards_path, name), 'r|') as tar:
+            for member in tar:
+                key, extension = os.path.splitext(member.name)
+                payload = tar.extractfile(member).read()
+                if extension == '.cls':
+                    sample['target'] = int(payload.decode())
+                else:
+                    sample['image'] = payload
+                if len(sample) == 2:
+                    yield sample['image'], sample['target']
+                    sample = {}
+
+    def _decode(self, payload, target):
+        image = self.loader(io.BytesIO(payload))
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, target
+
+    def _records(self, epoch):
+        length = len(self)
+        shards = self._epoch_shards(epoch)[self.rank::self.world_size]
+        worker_info = data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+
+        # position of the first record of every shard in the records of this process, the ones past its
+        # length are dropped
+        position = 0
+        for index, shard in enumerate(shards):
+            if index % num_workers == worker_id:
+                for offset, record in enumerate(self._read_shard(shard['name'])):
+                    if position + offset >= length:
+                        break
+                    yield record
+            position += shard['count']
+
+        # padding up to the length, repeating the first records of the process
+        padding = length - position
+        if worker_id == 0 and padding > 0:
+            while True:
+                for shard in shards or self._epoch_shards(epoch):
+                    for record in self._read_shard(shard['name']):
+                        yield record
+                        padding -= 1
+                        if padding == 0:
+                            return
+
+    def __iter__(self):
+        epoch = int(self.epoch)
+        worker_info = data.get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        rng = random.Random(self.seed + 1000 * epoch + 100 * self.rank + worker_id)
+
+        buffer = []
+        for payload, target in self._records(epoch):
+            if not self.shuffle:
+                yield self._decode(payload, target)
+                continue
+            # encoded records wait in the shuffle buffer, only the emitted one is decoded
+            if len(buffer) < self.buffer_size:
+                buffer.append((payload, target))
+                continue
+            index = rng.randrange(len(buffer))
+            buffer[index], (payload, target) = (payload, target), buffer[index]
+            yield self._decode(payload, target)
+
+        rng.shuffle(buffer)
+        for payload, target in buffer:
+            yield self._decode(payload, target)
+
+
+if __name__ == '__main__':
+    export_all_shards()
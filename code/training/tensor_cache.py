@@ -0,0 +1,107 @@
+import os
+import json
+import hashlib
+import shutil
+import numpy as np
+import torch
+from torch.utils import data
+from torchvision import transforms
+
+from code.training.manifest import get_source_dataset, source_meta, source_is_current
+
+"""
+    Pre-decoded dataset cache: every image of a split is decoded and resized once to the
+    input shape of a model and stored as a uint8 (N, 3, H, W) memory-mapped array, so
+    epochs only pay for augmentation instead of JPEG decoding. The cache records a fingerprint of the
+    files and labels it was built from, and is ignored once the split or the manifest changes.
+"""
+
+CACHE_ROOT = 'sets_cache'
+
+MODEL_SHAPES = [(50, 50), (224, 224), (299, 299)]
+
+
+def get_cache_path(set_path, shape, cache_root=CACHE_ROOT):
+    # splits of different roots share a basename, the hash of the full path keeps their caches apart
+    set_path = os.path.abspath(set_path)
+    path_hash = hashlib.sha1(set_path.encode()).hexdigest()[:10]
+    return os.path.join(cache_root, f'{shape[0]}x{shape[1]}', f'{os.path.basename(set_path)}_{path_hash}')
+
+
+def tensor_cache_exists(set_path, shape, cache_root=CACHE_ROOT):
+    meta_path = os.path.join(get_cache_path(set_path, shape, cache_root), 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    return source_is_current(meta_path, set_path, f'Tensor cache at {shape[0]}x{shape[1]}')
+
+
+def build_tensor_cache(set_path, shape, cache_root=CACHE_ROOT, num_workers=4, overwrite=False):
+    cache_path = get_cache_path(set_path, shape, cache_root)
+    if tensor_cache_exists(set_path, shape, cache_root) and not overwrite:
+        return cache_path
+
+    # same resize as the PIL pipeline, stopping before ToTensor so pixels stay uint8
+    source = get_source_dataset(set_path, transforms.Compose([
+        transforms.Resize(shape),
+        transforms.PILToTensor()
+    ]))
+    loader = data.DataLoader(source, batch_size=256, shuffle=False, num_workers=num_workers)
+
+    # write into a temporary folder and rename it, so a crashed build never looks complete
+    tmp_path = cache_path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    images = np.lib.format.open_memmap(os.path.join(tmp_path, 'images.npy'), mode='w+', dtype=np.uint8,
+                                       shape=(len(source), 3, shape[0], shape[1]))
+    labels = np.empty(len(source), dtype=np.int64)
+    start = 0
+    for batch, targets in loader:
+        images[start:start + batch.size(0)] = batch.numpy()
+        labels[start:start + batch.size(0)] = targets.numpy()
+        start += batch.size(0)
+    images.flush()
+    del images
+    np.save(os.path.join(tmp_path, 'labels.npy'), labels)
+
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(dict({'shape': list(shape), 'count': len(source), 'classes': source.classes},
+                       **source_meta(source, set_path)), f)
+
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    os.replace(tmp_path, cache_path)
+    print(f'Tensor cache for {set_path} at {shape[0]}x{shape[1]} written to {cache_path}')
+    return cache_path
+
+
+def build_tensor_caches(sets_folder='sets', shapes=MODEL_SHAPES, cache_root=CACHE_ROOT, overwrite=False):
+    for split in ['training', 'validation', 'test']:
+        for shape in shapes:
+            build_tensor_cache(os.path.join(sets_folder, split), tuple(shape), cache_root, overwrite=overwrite)
+
+
+class TensorCacheDataset(data.Dataset):
+    def __init__(self, set_path, shape, transform=None, cache_root=CACHE_ROOT):
+        cache_path = get_cache_path(set_path, shape, cache_root)
+        with open(os.path.join(cache_path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.classes = meta['classes']
+        self.transform = transform
+        # copy-on-write mapping: pages are shared between workers and tensors are built without copying
+        self.images = np.load(os.path.join(cache_path, 'images.npy'), mmap_mode='c')
+        self.targets = np.load(os.path.join(cache_path, 'labels.npy')).tolist()
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        image = torch.from_numpy(self.images[index])
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.targets[index]
+
+
+if __name__ == '__main__':
+    build_tensor_caches()
@@ -1,85 +1,121 @@
 import os
+import time
+import contextlib
 import torch
 import torchvision.datasets
 from torch.utils import data
 from torchvision import transforms
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from torch import nn
-from sklearn.metrics import f1_score, confusion_matrix, precision_score, recall_score
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sn
 import pandas as pd
-from decimal import Decimal
 import shutil
 
 from code.training.models import get_model
-from code.training.auxiliary import create_sets, create_dataloader, get_device
+from code.training.auxiliary import create_sets, create_dataloader, get_dataloader, get_device, get_amp_dtype, \
+    get_memory_format, release_dataloader, set_loader_epoch
+from code.training.augmentation import BatchAugmentation
+from code.training.manifest import get_classes
+from code.training.metrics import MetricsAccumulator
+from code.training.memory import get_micro_batch_size
+from code.training.feature_cache import split_frozen_prefix, verify_suffix, get_feature_dataset
+from code.training.checkpoint import AsyncCheckpointer, get_checkpoint_path, load_checkpoint, get_rng_state, \
+    set_rng_state
+from code.training.distributed import is_distributed, is_main_process, get_rank, get_world_size, barrier, \
+    launch, launched_by_torchrun, wrap_model, get_sampler
+from code.training.compilation import compile_model, unwrap_model
+from code.training.resizing import get_resize_stages, get_stage
+from code.training.distillation import DistillationLoss, get_teacher_logits, get_distillation_loader
+from code.training.quantization import get_quantized_path, load_quantized_model, prepare_qat, freeze_qat, \
+    convert_qat, save_quantized_model
 from code.utils.performance import folder_to_zip
 
-def train(train_loader, model, optimizer, criterion, device):
+def train(train_loader, model, optimizer, criterion, device, batch_transform=None, amp_dtype=None, scaler=None,
+          memory_format=None, micro_batch_size=None):
     model.train()
-    train_loss = 0.0
-    true_labels = []
-    predicted_labels = []
-    total = 0
+    metrics = MetricsAccumulator()
 
     for images, labels in train_loader:
         optimizer.zero_grad()
         images, labels = images.to(device), labels.to(device)
+        if batch_transform is not None:
+            images = batch_transform(images)
+        if memory_format is not None:
+            images = images.contiguous(memory_format=memory_format)
+
+        # gradients of the micro-batches are accumulated, each weighted by its share of the batch mean loss
+        micro_batch = micro_batch_size or labels.size(0)
+        micro_batches = list(zip(images.split(micro_batch), labels.split(micro_batch)))
+        for i, (micro_images, micro_labels) in enumerate(micro_batches):
+            # with DDP the gradients are all-reduced once, after the last micro-batch
+            no_sync = getattr(model, 'no_sync', None)
+            sync = no_sync() if no_sync is not None and i < len(micro_batches) - 1 else contextlib.nullcontext()
+            with sync:
+                with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                    outputs = model(micro_images)
+                    loss = criterion(outputs, micro_labels)
+
+                weighted_loss = loss * (micro_labels.size(0) / labels.size(0))
+                if scaler is not None:
+                    scaler.scale(weighted_loss).backward()
+                else:
+                    weighted_loss.backward()
+
+            # distillation targets carry the teacher logits after the label
+            metrics.update(loss, outputs, micro_labels if micro_labels.dim() == 1 else micro_labels[:, 0].long())
+
+        if scaler is not None:
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            optimizer.step()
 
-        outputs = model(images)
-        loss = criterion(outputs, labels)
-
-        loss.backward()
-        optimizer.step()
-
-        train_loss += loss.item() * images.size(0)
-        _, preds = torch.max(outputs.data, 1)
-        true_labels.extend(labels.cpu().numpy())
-        predicted_labels.extend(preds.cpu().numpy())
-        total += labels.size(0)
-
-    train_loss /= len(train_loader.dataset)
-    train_acc = sum([1 for i, j in zip(true_labels, predicted_labels) if i == j]) / total
-    train_f1 = f1_score(true_labels, predicted_labels, average='macro')
+    metrics.all_reduce()
+    results = metrics.compute()
+    train_loss, train_acc, train_f1 = results['loss'], results['accuracy'], results['f1']
 
-    print('Train loss: {:.3f}, Train accuracy: {:.3f}, Train Macro F1-score: {:.3f}'.format(train_loss, train_acc, train_f1))
+    if is_main_process():
+        print('Train loss: {:.3f}, Train accuracy: {:.3f}, Train Macro F1-score: {:.3f}'.format(train_loss, train_acc, train_f1))
 
     return train_loss, train_acc, train_f1
 
 
-def test(test_loader, model, criterion, device):
+def evaluate(test_loader, model, criterion, device, batch_transform=None, amp_dtype=None, memory_format=None):
     model.eval()
-    test_loss = 0.0
-    true_labels = []
-    predicted_labels = []
-    total = 0
+    metrics = MetricsAccumulator()
 
     with torch.no_grad():
         for images, labels in test_loader:
             images, labels = images.to(device), labels.to(device)
+            if batch_transform is not None:
+                images = batch_transform(images)
+            if memory_format is not None:
+                images = images.contiguous(memory_format=memory_format)
+
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                outputs = model(images)
+                loss = criterion(outputs, labels)
 
-            outputs = model(images)
-            loss = criterion(outputs, labels)
+            metrics.update(loss, outputs, labels)
 
-            test_loss += loss.item() * images.size(0)
-            _, preds = torch.max(outputs.data, 1)
-            true_labels.extend(labels.cpu().numpy())
-            predicted_labels.extend(preds.cpu().numpy())
-            total += labels.size(0)
+    metrics.all_reduce()
+    return metrics.compute()
 
-    test_loss /= len(test_loader.dataset)
-    test_acc = sum([1 for i, j in zip(true_labels, predicted_labels) if i == j]) / total
-    test_f1 = f1_score(true_labels, predicted_labels, average='macro')
-    conf_matrix = confusion_matrix(true_labels, predicted_labels)
 
-    print('Test loss: {:.3f}, Test accuracy: {:.3f}, Test Macro F1-score: {:.3f}'.format(test_loss, test_acc, test_f1))
+def test(test_loader, model, criterion, device, batch_transform=None, amp_dtype=None, memory_format=None):
+    results = evaluate(test_loader, model, criterion, device, batch_transform, amp_dtype, memory_format)
+    test_loss, test_acc, test_f1, conf_matrix = results['loss'], results['accuracy'], results['f1'], \
+        results['confusion_matrix']
+
+    if is_main_process():
+        print('Test loss: {:.3f}, Test accuracy: {:.3f}, Test Macro F1-score: {:.3f}'.format(test_loss, test_acc, test_f1))
 
     return test_loss, test_acc, test_f1, conf_matrix
 
 
-def train_on_cifar(model_name, model, shape, device):
+def train_on_cifar(model_name, model, shape, device, autotune=False, memory_format=None, models_dir='models'):
     transform_train = transforms.Compose([
         transforms.Resize(shape),
         transforms.RandomHorizontalFlip(),
@@ -96,10 +132,9 @@ def train_on_cifar(model_name, model, shape, device):
     train_dataset = torchvision.datasets.CIFAR10(root='.', train=True, transform=transform_train, download=True)
     test_dataset = torchvision.datasets.CIFAR10(root='.', train=False, transform=transform_test, download=True)
 
-    train_loader = data.DataLoader(train_dataset, batch_size=64, shuffle=True, num_workers=4, prefetch_factor=8,
-                                 pin_memory=True, persistent_workers=True)
-    test_loader = data.DataLoader(test_dataset, batch_size=64, shuffle=False, num_workers=4, prefetch_factor=8,
-                                 pin_memory=True, persistent_workers=True)
+    cifar_settings = {'num_workers': 4, 'prefetch_factor': 8, 'pin_memory': True}
+    train_loader = create_dataloader(train_dataset, 64, autotune=autotune, defaults=cifar_settings)
+    test_loader = create_dataloader(test_dataset, 64, shuffle=False, autotune=autotune, defaults=cifar_settings)
 
     criterion = nn.CrossEntropyLoss()
     optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
@@ -109,19 +144,21 @@ def train_on_cifar(model_name, model, shape, device):
 
     for epoch in range(0, 500):
         print(f'Epoch: {epoch}')
+        set_loader_epoch(train_loader, epoch)
         _ = train(
             train_loader,
             model,
             optimizer,
             criterion,
-            device
+            device,
+            memory_format=memory_format
         )
-        test_loss, _, _, _ = test(test_loader, model, criterion, device)
+        test_loss, _, _, _ = test(test_loader, model, criterion, device, memory_format=memory_format)
 
         if test_loss <= best_loss:
             best_loss = test_loss
             print('Saving model')
-            torch.save(model.state_dict(), os.path.join('models', model_name, f'{model_name}.pkl'))
+            torch.save(model.state_dict(), os.path.join(models_dir, model_name, f'{model_name}.pkl'))
             convergence = 0
         else:
             convergence += 1
@@ -131,9 +168,24 @@ def train_on_cifar(model_name, model, shape, device):
             break
 
 
-def train_model(cfg):
+def create_scheduler(optimizer, cfg):
+    if not cfg['optimizer_scheduler']:
+        return None
+    return ReduceLROnPlateau(optimizer, 'min', factor=cfg['scheduler_gamma'], patience=cfg['scheduler_patience'],
+                             threshold=cfg['scheduler_threshold'], threshold_mode='rel', verbose=True)
+
+
+def train_model(cfg, resume=False):
+    # continue from models/<model_name>/checkpoint.pt, with the state of the epoch it was written after
+    resume = resume or cfg.get('resume', False)
+
+    # data-parallel training starts the worker processes, which run train_model again
+    if not is_distributed() and (cfg.get('distributed_processes', 1) > 1 or launched_by_torchrun()):
+        return launch(train_model, dict(cfg, resume=resume), cfg.get('distributed_processes', 1))
+
     # select the appropriate model
     model_name = cfg['model_name']
+    models_dir = cfg.get('models_dir', 'models')
 
     # hyperparameters
     seed = cfg['seed']
@@ -143,15 +195,22 @@ def train_model(cfg):
     learning_rate = cfg['learning_rate']
 
     # create sets from original folder if not yet present
-    if not os.path.exists('sets'):
+    if is_main_process() and not os.path.exists('sets'):
         create_sets(dataset_path)
 
-    num_classes = len(os.listdir(os.path.join('sets', 'training')))
-
     # check if model directory is present
-    if not os.path.exists(os.path.join('models', model_name)):
-        os.makedirs(os.path.join('models', model_name))
-        os.makedirs(os.path.join('models', model_name, 'performance'))
+    if is_main_process() and not os.path.exists(os.path.join(models_dir, model_name)):
+        os.makedirs(os.path.join(models_dir, model_name))
+        os.makedirs(os.path.join(models_dir, model_name, 'performance'))
+    barrier()
+
+    num_classes = len(get_classes(os.path.join('sets', 'training')))
+
+    # the batch size is global, every process takes its share of each batch
+    world_size = get_world_size()
+    if batch_size % world_size != 0:
+        print(f'Batch size {batch_size} is not divisible by {world_size} processes')
+    batch_size = max(1, batch_size // world_size)
 
     # check if cuda is available and set device along with cuda seed
     device = get_device(seed)
@@ -170,71 +229,197 @@ def train_model(cfg):
     val_losses = []
     val_accuracies = []
     val_f1_scores = []
+    # wall-clock seconds of every epoch, training and validation
+    epoch_times = []
+
+    # channels_last keeps activations in NHWC end to end, avoiding layout reorders in oneDNN convolutions
+    memory_format = get_memory_format(cfg)
+
+    # quantization-aware training fine-tunes a fake-quantized model, its files are kept apart from the fp32 ones
+    qat = cfg.get('qat_epochs', 0) > 0
+    if qat:
+        epochs = cfg['qat_epochs']
+    suffix = '_qat' if qat else ''
+    weights_path = os.path.join(models_dir, model_name, f'{model_name}{suffix}.pkl')
+    memory_efficient = None if qat else cfg.get('memory_efficient')
+
+    checkpoint_path = get_checkpoint_path(model_name, models_dir)
+    if qat:
+        checkpoint_path = os.path.splitext(checkpoint_path)[0] + suffix + '.pt'
+    checkpoint = load_checkpoint(checkpoint_path) if resume else None
+    if resume and checkpoint is None:
+        print(f'No checkpoint found in {checkpoint_path}, training from the start')
 
     # pretrain the model on CIFAR-10
     if cfg['pretrain_CIFAR']:
         model, shape = get_model(model_name, cfg['pretrained_weights'], cfg['finetune_layer'], cfg['pretrained_model'],
-                                 10, cfg['layers'])
-        model.to(device)
-        train_on_cifar(model_name, model, shape, device)
-        model.load_state_dict(torch.load(os.path.join('models', model_name, f'{model_name}.pkl')))
+                                 10, cfg['layers'], memory_efficient=memory_efficient, models_dir=models_dir)
+        model.to(device, memory_format=memory_format)
+        if checkpoint is None:
+            if is_main_process():
+                train_on_cifar(model_name, model, shape, device, cfg.get('autotune_loader', False), memory_format,
+                               models_dir)
+            barrier()
+            model.load_state_dict(torch.load(os.path.join(models_dir, model_name, f'{model_name}.pkl')))
         model.fc = nn.Linear(model.fc.in_features, num_classes)
     else:
         model, shape = get_model(model_name, cfg['pretrained_weights'], cfg['finetune_layer'], cfg['pretrained_model'],
-                                 num_classes, cfg['layers'])
+                                 num_classes, cfg['layers'], memory_efficient=memory_efficient, models_dir=models_dir)
         model.to(device)
 
+    if qat:
+        model = prepare_qat(model, shape, cfg.get('quantization_backend', 'x86'))
+
     # dataset and augmentation
-    transforms_list = [transforms.Resize(shape)]
-
-    if cfg['fliplr']:   # horizontal flip
-        transforms_list.append(transforms.RandomHorizontalFlip())
-    if cfg['gaussian_blur']:    # Gaussian blur
-        transforms_list.append(transforms.GaussianBlur(cfg['gaussian_kernel'], (cfg['sigma_min'], cfg['sigma_max'])))
-    if cfg['affine']:    # affine
-        transforms_list.append(transforms.RandomAffine(cfg['affine_percent'], scale=(cfg['affine_scale_min'], cfg['affine_scale_max'])))
-    if cfg['jitter']:
-        transforms_list.append(
-            transforms.ColorJitter(brightness=(cfg['jitter_min'], cfg['jitter_max']),
-                                   contrast=(cfg['jitter_min'], cfg['jitter_max']),
-                                   hue=cfg['jitter_hue'],
-                                   saturation=(cfg['jitter_min'], cfg['jitter_max'])))
-
-    transforms_list.append(transforms.ToTensor())
-    transforms_list.append(transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]))
-    transform = transforms.Compose(transforms_list)
-
-    val_transform = transforms.Compose([
-            transforms.Resize(shape),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
+    train_loader = get_dataloader(os.path.join('sets', 'training'), cfg, shape, batch_size, augment=True)
+    val_loader = get_dataloader(os.path.join('sets', 'validation'), cfg, shape, batch_size, shuffle=False)
 
-    train_loader = create_dataloader(os.path.join('sets', 'training'), transform, batch_size)
-    val_loader = create_dataloader(os.path.join('sets', 'validation'), val_transform, batch_size)
+    if cfg.get('batch_augmentation', False):
+        train_transform = BatchAugmentation(cfg, device, seed=seed + get_rank())
+        val_transform = BatchAugmentation(cfg, device, augment=False)
+    else:
+        train_transform = None
+        val_transform = None
 
     optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate, amsgrad=True)
 
-    if cfg['optimizer_scheduler']:
-        scheduler = ReduceLROnPlateau(optimizer, 'min', factor=cfg['scheduler_gamma'],
-                                      patience=cfg['scheduler_patience'], threshold=cfg['scheduler_threshold'],
-                                      threshold_mode='rel', verbose=True)
-    else:
-        scheduler = None
+    scheduler = create_scheduler(optimizer, cfg)
 
     criterion = nn.CrossEntropyLoss()
-    model.to(device)
 
-    for epoch in range(0, epochs):
-        print(f'Epoch: {epoch}')
+    # mixed precision: bfloat16 needs no loss scaling, float16 does
+    amp_dtype = get_amp_dtype(cfg)
+    scaler = torch.amp.GradScaler(device.type) if amp_dtype == torch.float16 else None
+
+    # knowledge distillation: the student learns from teacher logits computed once per image and variant
+    teacher_logits = None
+    train_criterion = criterion
+    if cfg.get('teacher_model'):
+        # rank 0 writes the logits cache first, the other ranks then read it
+        if not is_main_process():
+            barrier()
+        teacher_logits = get_teacher_logits(cfg, os.path.join('sets', 'training'), num_classes, device, amp_dtype)
+        if is_main_process():
+            barrier()
+        train_loader = get_distillation_loader(os.path.join('sets', 'training'), cfg, shape, batch_size,
+                                               teacher_logits)
+        train_criterion = DistillationLoss(cfg.get('distillation_temperature', 4.0),
+                                           cfg.get('distillation_alpha', 0.9))
+        # training images are augmented per sample, with the seeds the teacher saw
+        train_transform = None
+
+    start_epoch = 0
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        if scheduler is not None and checkpoint['scheduler'] is not None:
+            scheduler.load_state_dict(checkpoint['scheduler'])
+        if scaler is not None and checkpoint['scaler'] is not None:
+            scaler.load_state_dict(checkpoint['scaler'])
+        if train_transform is not None and checkpoint['augmentation'] is not None:
+            train_transform.generator.set_state(checkpoint['augmentation'])
+        best_loss, convergence = checkpoint['best_loss'], checkpoint['convergence']
+        train_losses, train_accuracies, train_f1_scores = checkpoint['train_losses'], \
+            checkpoint['train_accuracies'], checkpoint['train_f1_scores']
+        val_losses, val_accuracies, val_f1_scores = checkpoint['val_losses'], checkpoint['val_accuracies'], \
+            checkpoint['val_f1_scores']
+        epoch_times = checkpoint.get('epoch_times', [])
+        # a run that had converged has nothing left to do
+        start_epoch = epochs if checkpoint.get('converged', convergence > cfg['convergence']) \
+            else checkpoint['epoch'] + 1
+        if is_main_process():
+            print(f'Resuming from epoch {start_epoch}')
+
+    model.to(device, memory_format=memory_format)
+
+    # with a frozen backbone only the trainable suffix is trained, on prefix activations computed once per image
+    network = model
+    split = split_frozen_prefix(model) if cfg.get('feature_cache') and teacher_logits is None and not qat else None
+    if split is not None and not verify_suffix(model, *split, torch.randn(2, 3, *shape, device=device)):
+        print(f'The frozen prefix of {model_name} cannot be cached, training the full model')
+        split = None
+    if split is not None:
+        split_module, network = split
+        # rank 0 writes the disk cache first, the other ranks then read it
+        if not is_main_process():
+            barrier()
+        train_data = get_feature_dataset(cfg, model, split_module, os.path.join('sets', 'training'), shape, device,
+                                         True, train_transform, memory_format, batch_size)
+        val_data = get_feature_dataset(cfg, model, split_module, os.path.join('sets', 'validation'), shape, device,
+                                       False, val_transform, memory_format, batch_size)
+        if is_main_process():
+            barrier()
+        feature_settings = {'num_workers': 0, 'prefetch_factor': None, 'pin_memory': False}
+        train_loader = create_dataloader(train_data, batch_size, defaults=feature_settings,
+                                         sampler=get_sampler(train_data, True, seed))
+        val_loader = create_dataloader(val_data, batch_size, shuffle=False, defaults=feature_settings,
+                                       sampler=get_sampler(val_data, False, seed))
+        train_transform, val_transform, memory_format = None, None, None
+
+    # the cached features have the full input shape, progressive resizing needs the full model
+    stages = get_resize_stages(cfg.get('resize_stages'), shape, batch_size, epochs)
+    if split is not None and len(stages) > 1:
+        print('Progressive resizing is not used with the feature cache')
+        stages = stages[-1:]
+    stage = None
+
+    micro_batch_size = get_micro_batch_size(cfg, model, shape, device, amp_dtype, memory_format, batch_size)
+    network = wrap_model(network, device)
+    if split is None:
+        network = compile_model(network, shape, cfg.get('compile_mode'), device, train=True,
+                                memory_format=memory_format)
+
+    # restored last, preparing the model above draws random numbers
+    if checkpoint is not None:
+        set_rng_state(checkpoint['rng'])
+
+    # checkpoints are written by a background thread of the main process while the next epoch runs
+    checkpointer = AsyncCheckpointer() if is_main_process() else None
+
+    for epoch in range(start_epoch, epochs):
+        if is_main_process():
+            print(f'Epoch: {epoch}')
+
+        if get_stage(stages, epoch) is not stage:
+            stage = get_stage(stages, epoch)
+            if len(stages) > 1:
+                if is_main_process():
+                    print(f"Training at {stage['shape']} with batches of {stage['batch_size']}")
+                # the loader of the previous stage, and its workers, are not used again
+                release_dataloader(train_loader)
+                if teacher_logits is not None:
+                    train_loader = get_distillation_loader(os.path.join('sets', 'training'), cfg, stage['shape'],
+                                                           stage['batch_size'], teacher_logits)
+                else:
+                    train_loader = get_dataloader(os.path.join('sets', 'training'), cfg, stage['shape'],
+                                                  stage['batch_size'], augment=True)
+                micro_batch_size = get_micro_batch_size(cfg, model, stage['shape'], device, amp_dtype,
+                                                        memory_format, stage['batch_size'])
+            # a resumed run keeps the learning rate, scheduler and counter of the stage it stopped in
+            if epoch == stage['start']:
+                for group in optimizer.param_groups:
+                    group['lr'] = learning_rate * stage['lr_factor']
+                scheduler = create_scheduler(optimizer, cfg)
+                convergence = 0
+
+        epoch_start = time.perf_counter()
+        if qat:
+            freeze_qat(model, epoch, epochs)
+        set_loader_epoch(train_loader, epoch)
         train_loss, train_acc, train_f1 = train(
             train_loader,
-            model,
+            network,
             optimizer,
-            criterion,
-            device
+            train_criterion,
+            device,
+            train_transform,
+            amp_dtype,
+            scaler,
+            memory_format,
+            micro_batch_size
         )
-        val_loss, val_acc, val_f1, _ = test(val_loader, model, criterion, device)
+        val_loss, val_acc, val_f1, _ = test(val_loader, network, criterion, device, val_transform, amp_dtype,
+                                            memory_format)
 
         if scheduler is not None:
             scheduler.step(val_loss)
@@ -245,68 +430,108 @@ def train_model(cfg):
         val_losses.append(val_loss)
         val_accuracies.append(val_acc)
         val_f1_scores.append(val_f1)
+        epoch_times.append(time.perf_counter() - epoch_start)
 
+        # the validation loss is the same on every rank, so all of them stop together
         if val_loss <= best_loss:
             best_loss = val_loss
-            print('Saving model')
-            torch.save(model.state_dict(), os.path.join('models', model_name, f'{model_name}.pkl'))
+            if is_main_process():
+                print('Saving model')
+                checkpointer.save(unwrap_model(model).state_dict(), weights_path)
             convergence = 0
         else:
             convergence += 1
 
-        if convergence > cfg['convergence']:
-            print('Model converged')
+        # early stopping only ends the last stage of progressive resizing
+        converged = convergence > cfg['convergence'] and stage is stages[-1]
+
+        if is_main_process():
+            checkpointer.save({
+                'model': unwrap_model(model).state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict() if scheduler is not None else None,
+                'scaler': scaler.state_dict() if scaler is not None else None,
+                'augmentation': train_transform.generator.get_state() if train_transform is not None else None,
+                'rng': get_rng_state(),
+                'epoch': epoch,
+                'best_loss': best_loss,
+                'convergence': convergence,
+                'converged': converged,
+                'train_losses': train_losses,
+                'train_accuracies': train_accuracies,
+                'train_f1_scores': train_f1_scores,
+                'val_losses': val_losses,
+                'val_accuracies': val_accuracies,
+                'val_f1_scores': val_f1_scores,
+                'epoch_times': epoch_times,
+            }, checkpoint_path)
+
+        if converged:
+            if is_main_process():
+                print('Model converged')
             break
 
-    np.save(os.path.join('models', model_name, 'performance', 'train_losses.npy'), train_losses)
-    np.save(os.path.join('models', model_name, 'performance', 'train_accuracies.npy'), train_accuracies)
-    np.save(os.path.join('models', model_name, 'performance', 'train_f1_scores.npy'), train_f1_scores)
-    np.save(os.path.join('models', model_name, 'performance', 'val_losses.npy'), val_losses)
-    np.save(os.path.join('models', model_name, 'performance', 'val_accuracies.npy'), val_accuracies)
-    np.save(os.path.join('models', model_name, 'performance', 'val_f1_scores.npy'), val_f1_scores)
-
-
-def test2(test_loader, model, criterion, device):
-    model.eval()
-    test_loss = 0.0
-    true_labels = []
-    predicted_labels = []
-    total = 0
-
-    with torch.no_grad():
-        for images, labels in test_loader:
-            images, labels = images.to(device), labels.to(device)
-
-            outputs = model(images)
-            loss = criterion(outputs, labels)
-
-            test_loss += loss.item() * images.size(0)
-            _, preds = torch.max(outputs.data, 1)
-            true_labels.extend(labels.cpu().numpy())
-            predicted_labels.extend(preds.cpu().numpy())
-            total += labels.size(0)
-
-    test_loss /= len(test_loader.dataset)
-    test_acc = Decimal(sum([1 for i, j in zip(true_labels, predicted_labels) if i == j])) / Decimal(total)
-    miss_classified = sum([1 for i, j in zip(true_labels, predicted_labels) if i != j])
-    test_f1 = f1_score(true_labels, predicted_labels, average='macro')
-    test_precision = precision_score(true_labels, predicted_labels, average='macro')
-    test_recall = recall_score(true_labels, predicted_labels, average='macro')
-    conf_matrix = confusion_matrix(true_labels, predicted_labels)
-
-    print('Test loss: {:.3f}, Test accuracy: {:.3f}, Test Macro F1-score: {:.3f}'.format(test_loss, test_acc, test_f1))
+    if checkpointer is not None:
+        try:
+            checkpointer.wait()
+        finally:
+            checkpointer.close()
+    if not is_main_process():
+        return best_loss
+
+    if qat:
+        # the best fake-quantized weights are converted to the int8 model
+        if os.path.exists(weights_path):
+            model.load_state_dict(torch.load(weights_path))
+        quantized_path = get_quantized_path(model_name, models_dir)
+        save_quantized_model(convert_qat(model), shape, quantized_path, cfg.get('quantization_backend', 'x86'))
+        print(f'Quantized model saved in {quantized_path}')
+
+    np.save(os.path.join(models_dir, model_name, 'performance', f'train_losses{suffix}.npy'), train_losses)
+    np.save(os.path.join(models_dir, model_name, 'performance', f'train_accuracies{suffix}.npy'), train_accuracies)
+    np.save(os.path.join(models_dir, model_name, 'performance', f'train_f1_scores{suffix}.npy'), train_f1_scores)
+    np.save(os.path.join(models_dir, model_name, 'performance', f'val_losses{suffix}.npy'), val_losses)
+    np.save(os.path.join(models_dir, model_name, 'performance', f'val_accuracies{suffix}.npy'), val_accuracies)
+    np.save(os.path.join(models_dir, model_name, 'performance', f'val_f1_scores{suffix}.npy'), val_f1_scores)
+    np.save(os.path.join(models_dir, model_name, 'performance', f'epoch_times{suffix}.npy'), epoch_times)
+    return best_loss
+
+
+def test2(test_loader, model, criterion, device, batch_transform=None, amp_dtype=None, memory_format=None):
+    results = evaluate(test_loader, model, criterion, device, batch_transform, amp_dtype, memory_format)
+    test_loss, test_acc, test_f1, conf_matrix = results['loss'], results['accuracy'], results['f1'], \
+        results['confusion_matrix']
+    miss_classified, test_precision, test_recall = results['miss_classified'], results['precision'], \
+        results['recall']
+
+    if is_main_process():
+        print('Test loss: {:.3f}, Test accuracy: {:.3f}, Test Macro F1-score: {:.3f}'.format(test_loss, test_acc, test_f1))
 
     return test_loss, test_acc, test_f1, conf_matrix, miss_classified, test_precision, test_recall
 
 
 def test_model(cfg):
     model_name = cfg['model_name']
-    num_classes = len(os.listdir(os.path.join('sets', 'test')))
-    model, shape = get_model(model_name, cfg['pretrained_weights'], cfg['finetune_layer'], cfg['pretrained_model'],
-                             num_classes, cfg['layers'])
+    models_dir = cfg.get('models_dir', 'models')
+    classes = get_classes(os.path.join('sets', 'test'))
+    num_classes = len(classes)
     device = get_device(cfg['seed'])
-
-    model.to(device)
+    memory_format = get_memory_format(cfg)
+    amp_dtype = get_amp_dtype(cfg)
+    # the results of the int8 model are written next to the fp32 ones
+    suffix = ''
+    if cfg.get('quantized', False):
+        # the int8 TorchScript model written by quantize_model runs on CPU kernels, in its own precision
+        model, shape = load_quantized_model(get_quantized_path(model_name, models_dir))
+        device, memory_format, amp_dtype = torch.device('cpu'), None, None
+        suffix = '_int8'
+    else:
+        model, shape = get_model(model_name, cfg['pretrained_weights'], cfg['finetune_layer'],
+                                 cfg['pretrained_model'], num_classes, cfg['layers'],
+                                 compile_mode=cfg.get('compile_mode'), device=device,
+                                 memory_efficient=cfg.get('memory_efficient'), models_dir=models_dir,
+                                 optimize=cfg.get('optimize_inference', True), memory_format=memory_format)
+        model.to(device, memory_format=memory_format)
     model.eval()
 
     # add to increase the dataset size
@@ -315,42 +540,24 @@ def test_model(cfg):
             for i in range(9):
                 shutil.copy(os.path.join('sets', 'test', folder, image), os.path.join('sets', 'test', folder, image[:-4] + f'_{i}.jpg'))"""
 
-    """transform = transforms.Compose([
-        transforms.Resize(shape),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])"""
-    transforms_list = [transforms.Resize(shape)]
-
-    if cfg['fliplr']:  # horizontal flip
-        transforms_list.append(transforms.RandomHorizontalFlip())
-    if cfg['gaussian_blur']:  # Gaussian blur
-        transforms_list.append(transforms.GaussianBlur(cfg['gaussian_kernel'], (cfg['sigma_min'], cfg['sigma_max'])))
-    if cfg['affine']:  # affine
-        transforms_list.append(
-            transforms.RandomAffine(cfg['affine_percent'], scale=(cfg['affine_scale_min'], cfg['affine_scale_max'])))
-    if cfg['jitter']:
-        transforms_list.append(
-            transforms.ColorJitter(brightness=(cfg['jitter_min'], cfg['jitter_max']),
-                                   contrast=(cfg['jitter_min'], cfg['jitter_max']),
-                                   hue=cfg['jitter_hue'],
-                                   saturation=(cfg['jitter_min'], cfg['jitter_max'])))
-
-    transforms_list.append(transforms.ToTensor())
-    transforms_list.append(transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]))
-    transform = transforms.Compose(transforms_list)
-
-    test_loader = create_dataloader(os.path.join('sets', 'test'), transform, 64)
+    test_loader = get_dataloader(os.path.join('sets', 'test'), cfg, shape, 64, augment=True)
     criterion = nn.CrossEntropyLoss()
 
-    test_loss, test_acc, test_f1, conf_matrix, miss_classified, test_precision, test_recall = test2(test_loader, model, criterion, device)
-    with open(os.path.join('models', model_name, 'performance', 'test_results.txt'), 'w') as f:
+    test_transform = BatchAugmentation(cfg, device) if cfg.get('batch_augmentation', False) else None
+
+    test_loss, test_acc, test_f1, conf_matrix, miss_classified, test_precision, test_recall = test2(test_loader, model, criterion, device, test_transform, amp_dtype,
+                                                                                                   memory_format)
+    os.makedirs(os.path.join(models_dir, model_name, 'performance'), exist_ok=True)
+    with open(os.path.join(models_dir, model_name, 'performance', f'test_results{suffix}.txt'), 'w') as f:
         f.write('Test loss: {:.3f}, Test accuracy: {:.3f}, Test Macro F1-score: {:.3f}, Precision {:.3f}, Recall {:.3f}, Badly classified: {}'
                 .format(test_loss, test_acc, test_f1, test_precision, test_recall, miss_classified))
 
-    df_cm = pd.DataFrame(conf_matrix, index=[i for i in os.listdir(os.path.join('sets', 'training'))],
-                         columns=[i for i in os.listdir(os.path.join('sets', 'training'))])
+    df_cm = pd.DataFrame(conf_matrix, index=[i for i in classes], columns=[i for i in classes])
     plt.figure(figsize=(10, 10))
     sn.heatmap(df_cm, annot=True)
-    plt.savefig(os.path.join('models', model_name, 'performance', 'confusion_matrix.png'))
-    #folder_to_zip(os.path.join('models', model_name, 'performance'))
+    plt.savefig(os.path.join(models_dir, model_name, 'performance', f'confusion_matrix{suffix}.png'))
+    plt.close()
+    #folder_to_zip(os.path.join(models_dir, model_name, 'performance'))
+
+    return {'loss': test_loss, 'accuracy': test_acc, 'f1': test_f1, 'precision': test_precision,
+            'recall': test_recall, 'miss_classified': miss_classified}
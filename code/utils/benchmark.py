@@ -0,0 +1,368 @@
+import os
+import csv
+import time
+import resource
+import numpy as np
+import multiprocessing
+import torch
+from torch import nn
+
+from code.training.models import get_model
+from code.training.auxiliary import get_dataloader
+from code.training.manifest import get_classes
+from code.training.train_model import test, train_model
+from code.training.compilation import compile_model
+from code.training.custom_models import CustomDenseNet
+from code.training.memory import activation_bytes_per_sample
+from code.training.quantization import quantize_model, load_quantized_model
+from code.training.fusion import optimize_for_inference, max_difference
+
+"""
+    Per-architecture benchmarks of the training and inference options, reported as a printed table and a
+    csv file in benchmarks/.
+"""
+
+MODEL_NAMES = [
+    'resnet-fc-18',
+    'resnet-fc-50',
+    'resnet-fc-101',
+    'densenet-classifier-121',
+    'vgg-classifier-16',
+    'efficientnet_classifier_b0',
+    'inception_fc_v3',
+    'custom_resnet_3_3_3',
+    'custom_densenet_3_3_3',
+    'custom_senet_3_3_3',
+]
+
+
+def build_model(model_name, num_classes, layers=None, pretrained_model=True, models_dir='models'):
+    # trained weights are used when present, so accuracy numbers are meaningful
+    pretrained_model = pretrained_model and os.path.exists(os.path.join(models_dir, model_name, f'{model_name}.pkl'))
+    return get_model(model_name, False, 'fc', pretrained_model, num_classes, layers or [3, 3, 3],
+                     models_dir=models_dir)
+
+
+def get_num_classes():
+    if os.path.exists('sets'):
+        return len(get_classes(os.path.join('sets', 'test')))
+    return 10
+
+
+def time_steps(step, steps=10, warmup=2):
+    for _ in range(warmup):
+        step()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    return (time.perf_counter() - start) / steps
+
+
+def train_step(model, images, labels, optimizer, criterion, amp_dtype=None):
+    def step():
+        optimizer.zero_grad()
+        with torch.autocast(device_type=images.device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            loss = criterion(model(images), labels)
+        loss.backward()
+        optimizer.step()
+    return step
+
+
+def inference_step(model, images, amp_dtype=None):
+    def step():
+        with torch.no_grad(), torch.autocast(device_type=images.device.type, dtype=amp_dtype,
+                                             enabled=amp_dtype is not None):
+            model(images)
+    return step
+
+
+def validation_accuracy(cfg, model, shape, device, amp_dtype=None, batch_size=64):
+    if not os.path.exists('sets'):
+        return None
+    loader = get_dataloader(os.path.join('sets', 'validation'), cfg, shape, batch_size)
+    _, accuracy, _, _ = test(loader, model, nn.CrossEntropyLoss(), device, amp_dtype=amp_dtype)
+    return accuracy
+
+
+def write_report(rows, name):
+    os.makedirs('benchmarks', exist_ok=True)
+    path = os.path.join('benchmarks', f'{name}.csv')
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print(' | '.join(rows[0].keys()))
+    for row in rows:
+        print(' | '.join('{:.4g}'.format(v) if isinstance(v, float) else str(v) for v in row.values()))
+    print(f'Report written to {path}')
+    return path
+
+
+def benchmark_mixed_precision(cfg, model_names=MODEL_NAMES, batch_size=32, steps=10, amp_dtype=torch.bfloat16):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    num_classes = get_num_classes()
+    criterion = nn.CrossEntropyLoss()
+    rows = []
+
+    for model_name in model_names:
+        model, shape = build_model(model_name, num_classes, cfg['layers'])
+        model.to(device)
+        images = torch.randn(batch_size, 3, *shape, device=device)
+        labels = torch.randint(0, num_classes, (batch_size,), device=device)
+        row = {'model': model_name}
+
+        for name, dtype in [('fp32', None), ('amp', amp_dtype)]:
+            state = {k: v.clone() for k, v in model.state_dict().items()}
+            optimizer = torch.optim.Adam(model.parameters(), lr=1e-6)
+            model.train()
+            row[f'train_{name}_img_s'] = batch_size / time_steps(train_step(model, images, labels, optimizer,
+                                                                            criterion, dtype), steps)
+            model.load_state_dict(state)
+            model.eval()
+            row[f'inference_{name}_img_s'] = batch_size / time_steps(inference_step(model, images, dtype), steps)
+            row[f'val_accuracy_{name}'] = validation_accuracy(cfg, model, shape, device, dtype)
+
+        row['train_speedup'] = row['train_amp_img_s'] / row['train_fp32_img_s']
+        row['inference_speedup'] = row['inference_amp_img_s'] / row['inference_fp32_img_s']
+        row['accuracy_delta'] = None
+        if row['val_accuracy_fp32'] is not None:
+            row['accuracy_delta'] = row['val_accuracy_amp'] - row['val_accuracy_fp32']
+        rows.append(row)
+
+    return write_report(rows, 'mixed_precision')
+
+
+def benchmark_compile(cfg, model_names=MODEL_NAMES, compile_mode='compile', batch_size=32, steps=10):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    num_classes = get_num_classes()
+    criterion = nn.CrossEntropyLoss()
+    rows = []
+
+    for model_name in model_names:
+        model, shape = build_model(model_name, num_classes, cfg['layers'])
+        model.to(device)
+        images = torch.randn(batch_size, 3, *shape, device=device)
+        labels = torch.randint(0, num_classes, (batch_size,), device=device)
+        row = {'model': model_name}
+
+        state = {k: v.clone() for k, v in model.state_dict().items()}
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-6)
+        model.train()
+        row['train_eager_s'] = time_steps(train_step(model, images, labels, optimizer, criterion), steps)
+        model.load_state_dict(state)
+        model.eval()
+        row['inference_eager_s'] = time_steps(inference_step(model, images), steps)
+
+        # tracing only produces an inference graph, training is then timed eagerly
+        start = time.perf_counter()
+        compiled = compile_model(model, shape, compile_mode, device, train=compile_mode == 'compile')
+        row['compile_s'] = time.perf_counter() - start
+        row['compiled'] = compiled is not model
+
+        if compile_mode == 'compile' and row['compiled']:
+            compiled.train()
+            row['train_compiled_s'] = time_steps(train_step(compiled, images, labels, optimizer, criterion), steps)
+            model.load_state_dict(state)
+        else:
+            row['train_compiled_s'] = row['train_eager_s']
+        compiled.eval()
+        row['inference_compiled_s'] = time_steps(inference_step(compiled, images), steps)
+
+        row['train_speedup'] = row['train_eager_s'] / row['train_compiled_s']
+        row['inference_speedup'] = row['inference_eager_s'] / row['inference_compiled_s']
+        rows.append(row)
+
+    return write_report(rows, f'compile_{compile_mode}')
+
+
+def nchw_fallbacks(model, images):
+    # modules whose 4D outputs lost the channels_last layout, each one costs a reorder in the next convolution
+    names = []
+    hooks = []
+    for name, module in model.named_modules():
+        def hook(module, inputs, output, name=name):
+            if isinstance(output, torch.Tensor) and output.dim() == 4 and output.size(1) > 1 and \
+                    not output.is_contiguous(memory_format=torch.channels_last):
+                names.append(name or type(module).__name__)
+        hooks.append(module.register_forward_hook(hook))
+    with torch.no_grad():
+        model(images)
+    for hook in hooks:
+        hook.remove()
+    return names
+
+
+def benchmark_channels_last(cfg, model_names=MODEL_NAMES, batch_size=32, steps=10):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    num_classes = get_num_classes()
+    criterion = nn.CrossEntropyLoss()
+    rows = []
+
+    for model_name in model_names:
+        model, shape = build_model(model_name, num_classes, cfg['layers'])
+        model.to(device)
+        images = torch.randn(batch_size, 3, *shape, device=device)
+        labels = torch.randint(0, num_classes, (batch_size,), device=device)
+        row = {'model': model_name}
+
+        state = {k: v.clone() for k, v in model.state_dict().items()}
+        for name, memory_format in [('nchw', torch.contiguous_format), ('channels_last', torch.channels_last)]:
+            model.to(memory_format=memory_format)
+            batch = images.contiguous(memory_format=memory_format)
+            optimizer = torch.optim.Adam(model.parameters(), lr=1e-6)
+            model.train()
+            row[f'train_{name}_img_s'] = batch_size / time_steps(train_step(model, batch, labels, optimizer,
+                                                                            criterion), steps)
+            model.load_state_dict(state)
+            model.eval()
+            row[f'inference_{name}_img_s'] = batch_size / time_steps(inference_step(model, batch), steps)
+
+        row['train_speedup'] = row['train_channels_last_img_s'] / row['train_nchw_img_s']
+        row['inference_speedup'] = row['inference_channels_last_img_s'] / row['inference_nchw_img_s']
+        row['nchw_fallbacks'] = ' '.join(nchw_fallbacks(model, images.contiguous(memory_format=torch.channels_last)))
+        rows.append(row)
+
+    return write_report(rows, 'channels_last')
+
+
+def _densenet_step(memory_efficient, growth_rate, block_config, batch_size, steps):
+    # run in a fresh process, so the peak resident memory on CPU is the one of this variant only
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = CustomDenseNet(10, growth_rate, block_config, memory_efficient).to(device)
+    images = torch.randn(batch_size, 3, 50, 50, device=device)
+    labels = torch.randint(0, 10, (batch_size,), device=device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-6)
+    step = train_step(model, images, labels, optimizer, nn.CrossEntropyLoss())
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated()
+    else:
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    step_s = time_steps(step, steps)
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated() - baseline
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - baseline
+    return peak / 1024 ** 2, step_s
+
+
+def benchmark_densenet_memory(growth_rates=(32, 48), block_configs=([3, 3, 3], [6, 12, 24]), batch_size=32,
+                              steps=5):
+    # on CPU the peak is the growth of the resident set over the timed steps, optimizer states included
+    context = multiprocessing.get_context('spawn')
+    rows = []
+    for growth_rate in growth_rates:
+        for block_config in block_configs:
+            for memory_efficient in [None, 'shared', 'recompute']:
+                model = CustomDenseNet(10, growth_rate, block_config, memory_efficient)
+                row = {'growth_rate': growth_rate, 'block_config': '_'.join(str(b) for b in block_config),
+                       'memory_efficient': memory_efficient or 'none',
+                       'activations_mb': batch_size * activation_bytes_per_sample(model, (50, 50),
+                                                                                  torch.device('cpu')) / 1024 ** 2}
+                with context.Pool(1) as pool:
+                    row['peak_mb'], row['step_s'] = pool.apply(_densenet_step, (memory_efficient, growth_rate,
+                                                                                block_config, batch_size, steps))
+                rows.append(row)
+
+    return write_report(rows, 'densenet_memory')
+
+
+def time_to_accuracy(accuracies, epoch_times, target):
+    # wall-clock seconds until the validation accuracy first reaches target, None if it never does
+    elapsed = 0.0
+    for accuracy, epoch_time in zip(accuracies, epoch_times):
+        elapsed += epoch_time
+        if accuracy >= target:
+            return elapsed
+    return None
+
+
+def benchmark_progressive_resizing(cfg, model_names=MODEL_NAMES[:7], resize_stages=((0.5, 4), (0.75, 3)),
+                                   target_accuracy=None):
+    # each backbone is trained at its fixed shape and with resize_stages, for cfg epochs; without target_accuracy
+    # the target is the best validation accuracy of the fixed-shape run
+    rows = []
+    for model_name in model_names:
+        row = {'model': model_name}
+        histories = {}
+        for name, stages in [('fixed', None), ('progressive', [list(stage) for stage in resize_stages])]:
+            models_dir = os.path.join('benchmarks', 'progressive_resizing', name)
+            start = time.perf_counter()
+            train_model(dict(cfg, model_name=model_name, resize_stages=stages, models_dir=models_dir))
+            row[f'{name}_total_s'] = time.perf_counter() - start
+            performance_dir = os.path.join(models_dir, model_name, 'performance')
+            histories[name] = (np.load(os.path.join(performance_dir, 'val_accuracies.npy')),
+                               np.load(os.path.join(performance_dir, 'epoch_times.npy')))
+            row[f'{name}_best_accuracy'] = float(histories[name][0].max())
+
+        row['target_accuracy'] = target_accuracy if target_accuracy is not None else row['fixed_best_accuracy']
+        for name, (accuracies, epoch_times) in histories.items():
+            row[f'{name}_time_to_target_s'] = time_to_accuracy(accuracies, epoch_times, row['target_accuracy'])
+        row['speedup'] = None
+        if row['fixed_time_to_target_s'] and row['progressive_time_to_target_s']:
+            row['speedup'] = row['fixed_time_to_target_s'] / row['progressive_time_to_target_s']
+        rows.append(row)
+
+    return write_report(rows, 'progressive_resizing')
+
+
+def benchmark_quantization(cfg, model_names=MODEL_NAMES, batch_sizes=(1, 8, 64), steps=10):
+    # int8 kernels are CPU only, both models are timed on CPU; models without trained weights are skipped
+    device = torch.device('cpu')
+    num_classes = get_num_classes()
+    criterion = nn.CrossEntropyLoss()
+    rows = []
+
+    for model_name in model_names:
+        weights_path = os.path.join(cfg.get('models_dir', 'models'), model_name, f'{model_name}.pkl')
+        quantized_path = quantize_model(dict(cfg, model_name=model_name)) if os.path.exists(weights_path) else None
+        if quantized_path is None:
+            print(f'No trained weights for {model_name}, skipped')
+            continue
+        quantized, shape = load_quantized_model(quantized_path)
+        model, shape = build_model(model_name, num_classes, cfg['layers'], models_dir=cfg.get('models_dir', 'models'))
+        model.eval()
+        row = {'model': model_name}
+
+        loader = get_dataloader(os.path.join('sets', 'test'), cfg, shape, 64, shuffle=False)
+        _, row['test_accuracy_fp32'], _, _ = test(loader, model, criterion, device)
+        _, row['test_accuracy_int8'], _, _ = test(loader, quantized, criterion, device)
+        row['accuracy_delta'] = row['test_accuracy_int8'] - row['test_accuracy_fp32']
+        row['size_fp32_mb'] = os.path.getsize(weights_path) / 1024 ** 2
+        row['size_int8_mb'] = os.path.getsize(quantized_path) / 1024 ** 2
+
+        for batch_size in batch_sizes:
+            images = torch.randn(batch_size, 3, *shape)
+            row[f'latency_fp32_b{batch_size}_ms'] = 1000 * time_steps(inference_step(model, images), steps)
+            row[f'latency_int8_b{batch_size}_ms'] = 1000 * time_steps(inference_step(quantized, images), steps)
+            row[f'speedup_b{batch_size}'] = row[f'latency_fp32_b{batch_size}_ms'] / row[f'latency_int8_b{batch_size}_ms']
+        rows.append(row)
+
+    return write_report(rows, 'quantization') if rows else None
+
+
+def benchmark_fusion(cfg, model_names=MODEL_NAMES, batch_sizes=(1, 32), steps=10):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    num_classes = get_num_classes()
+    rows = []
+
+    for model_name in model_names:
+        model, shape = build_model(model_name, num_classes, cfg['layers'])
+        model.to(device).eval()
+        optimized = optimize_for_inference(model, shape)
+        row = {'model': model_name, 'folded': optimized is not model,
+               'batchnorms': sum(isinstance(m, nn.BatchNorm2d) for m in model.modules()),
+               'batchnorms_folded': sum(isinstance(m, nn.BatchNorm2d) for m in model.modules())
+               - sum(isinstance(m, nn.BatchNorm2d) for m in optimized.modules()),
+               'max_difference': max_difference(model, optimized, shape)}
+
+        for batch_size in batch_sizes:
+            images = torch.randn(batch_size, 3, *shape, device=device)
+            row[f'latency_b{batch_size}_ms'] = 1000 * time_steps(inference_step(model, images), steps)
+            row[f'latency_folded_b{batch_size}_ms'] = 1000 * time_steps(inference_step(optimized, images), steps)
+            row[f'speedup_b{batch_size}'] = row[f'latency_b{batch_size}_ms'] / row[f'latency_folded_b{batch_size}_ms']
+        rows.append(row)
+
+    return write_report(rows, 'fusion')
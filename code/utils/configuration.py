@@ -9,6 +9,7 @@ def create_configuration_file(
         pretrained_model=False,     # get trained weights
         layers=[3, 3, 3],
         growth_rate=32,
+        memory_efficient=None,
         # TRAINING PARAMETERS
         batch_size=128,
         epochs=500,
@@ -19,6 +20,29 @@ def create_configuration_file(
         scheduler_patience=10,
         scheduler_threshold=1e-4,
         convergence=20,
+        autotune_loader=False,
+        mixed_precision=False,
+        amp_dtype='bfloat16',
+        compile_mode=None,
+        optimize_inference=True,
+        channels_last=False,
+        micro_batch_size=None,
+        memory_budget_mb=None,
+        distributed_processes=1,
+        resume=False,
+        feature_cache=None,
+        feature_cache_variants=5,
+        resize_stages=None,
+        teacher_model=None,
+        teacher_layers=None,
+        teacher_models_dir='models',
+        distillation_temperature=4.0,
+        distillation_alpha=0.9,
+        distillation_variants=5,
+        quantized=False,
+        quantization_backend='x86',
+        calibration_images=256,
+        qat_epochs=0,
         # DATA AUGMENTATION PARAMETERS
         fliplr=True,
         fliplr_value=0.5,
@@ -34,8 +58,12 @@ def create_configuration_file(
         jitter_min=0.8,
         jitter_max=1.2,
         jitter_hue=0.2,
+        batch_augmentation=False,
+        draft_decode=True,
         # GENERAL
         seed=42,
+        models_dir='models',
+        config_path='config.yaml',
 ):
     dictionary = {
         # MODEL PARAMETERS
@@ -46,6 +74,7 @@ def create_configuration_file(
         'pretrained_model': pretrained_model,
         'layers': layers,  # For layers (ResNet) block_config(DenseNet) [custom]
         'growth_rate': growth_rate,  # For growth_rate (DenseNet) [custom]
+        'memory_efficient': memory_efficient,  # None, 'shared' (concatenation buffer) or 'recompute' (DenseNet) [custom]
         # TRAINING PARAMETERS
         'batch_size': batch_size,
         'epochs': epochs,
@@ -56,6 +85,29 @@ def create_configuration_file(
         'scheduler_patience': scheduler_patience,
         'scheduler_threshold': scheduler_threshold,
         'convergence': convergence,
+        'autotune_loader': autotune_loader,  # benchmark and cache DataLoader settings for this machine
+        'mixed_precision': mixed_precision,  # autocast forward and loss
+        'amp_dtype': amp_dtype,  # bfloat16 (CPU and GPU) or float16 (GPU, with gradient scaling)
+        'compile_mode': compile_mode,  # None (eager), 'compile' (torch.compile) or 'trace' (TorchScript, inference)
+        'optimize_inference': optimize_inference,  # fold BatchNorm into the convolutions for testing and inference
+        'channels_last': channels_last,  # NHWC memory format for models and batches
+        'micro_batch_size': micro_batch_size,  # accumulate gradients over micro-batches of this size
+        'memory_budget_mb': memory_budget_mb,  # choose micro_batch_size automatically to fit this budget
+        'distributed_processes': distributed_processes,  # data-parallel training processes on this machine (gloo)
+        'resume': resume,  # continue training from models/<model_name>/checkpoint.pt
+        'feature_cache': feature_cache,  # None, 'memory' or 'disk': cache the frozen prefix activations
+        'feature_cache_variants': feature_cache_variants,  # augmented variants cached per training image
+        'resize_stages': resize_stages,  # [[scale, epochs(, batch_multiplier)], ...] before the full input shape
+        'teacher_model': teacher_model,  # trained model distilled into this one, from models/<teacher_model>
+        'teacher_layers': teacher_layers,  # layers of a custom teacher, None for the layers of this model
+        'teacher_models_dir': teacher_models_dir,  # models folder of the teacher, shared by sweep and search jobs
+        'distillation_temperature': distillation_temperature,  # softening of the teacher and student outputs
+        'distillation_alpha': distillation_alpha,  # weight of the teacher loss against the label loss
+        'distillation_variants': distillation_variants,  # augmented variants with cached teacher logits per image
+        'quantized': quantized,  # test the int8 model models/<model_name>/<model_name>_int8.pt
+        'quantization_backend': quantization_backend,  # int8 CPU kernels: 'x86' or 'qnnpack' (ARM)
+        'calibration_images': calibration_images,  # validation images observed to calibrate int8 ranges
+        'qat_epochs': qat_epochs,  # > 0: quantization-aware fine-tuning for this many epochs, exported to int8
         # DATA AUGMENTATION PARAMETERS
         'fliplr': fliplr,
         'fliplr_value': fliplr_value,
@@ -71,10 +123,13 @@ def create_configuration_file(
         'jitter_min': jitter_min,
         'jitter_max': jitter_max,
         'jitter_hue': jitter_hue,
+        'batch_augmentation': batch_augmentation,  # augment collated batches on the device
+        'draft_decode': draft_decode,  # decode JPEGs at reduced scale for small input shapes
         # GENERAL
         'seed': seed,
+        'models_dir': models_dir,  # weights, checkpoints and performance files of every model
     }
-    with open('config.yaml', 'w') as f:
+    with open(config_path, 'w') as f:
         yaml.dump(dictionary, f)
 
 
@@ -0,0 +1,164 @@
+import os
+import json
+import math
+import time
+import random
+import traceback
+import contextlib
+
+from code.utils.sweep import create_pool
+
+"""
+    Successive halving: num_trials configurations sampled from a search space are trained for min_epochs, then
+    the best 1/eta of them by validation loss are promoted to a budget eta times longer, rung after rung, until
+    max_epochs. Promoted trials resume from their checkpoint.pt instead of starting again, and trials that
+    converge early stop with the usual convergence counter. Every trial has its own config and models directory
+    under the search folder, and search.json records the trials and the result of every rung after each trial,
+    so a search started again with the same output_dir skips what is done and resumes the interrupted trials.
+
+    run_search({'model_name': 'custom_resnet_3_3_3', 'pretrained_weights': False},
+               {'learning_rate': (1e-4, 1e-2), 'batch_size': [32, 64, 128], 'scheduler_patience': [5, 10]})
+"""
+
+SEARCHES_ROOT = 'searches'
+
+
+def sample_configuration(space, rng):
+    # lists are choices, (low, high) tuples are sampled log-uniformly
+    config = {}
+    for key, values in space.items():
+        if isinstance(values, tuple):
+            low, high = values
+            config[key] = float(math.exp(rng.uniform(math.log(low), math.log(high))))
+        else:
+            config[key] = values[rng.randrange(len(values))]
+    return config
+
+
+def get_rungs(min_epochs, max_epochs, eta=3):
+    rungs = []
+    epochs = min_epochs
+    while epochs < max_epochs:
+        rungs.append(epochs)
+        epochs *= eta
+    return rungs + [max_epochs]
+
+
+def _trial_dir(output_dir, trial):
+    return os.path.join(output_dir, f'trial_{trial:03d}')
+
+
+def _train_trial(trial_dir, config, epochs):
+    from code.utils.configuration import create_configuration_file, load_configuration_file
+    from code.training.train_model import train_model
+    from code.training.checkpoint import get_checkpoint_path, load_checkpoint
+
+    models_dir = os.path.join(trial_dir, 'models')
+    config_path = os.path.join(trial_dir, 'config.yaml')
+    os.makedirs(trial_dir, exist_ok=True)
+    create_configuration_file(**dict(config, epochs=epochs, models_dir=models_dir, config_path=config_path))
+    cfg = load_configuration_file(config_path)
+
+    result = {'status': 'ok'}
+    start = time.perf_counter()
+    with open(os.path.join(trial_dir, 'log.txt'), 'a') as log, contextlib.redirect_stdout(log), \
+            contextlib.redirect_stderr(log):
+        try:
+            # the checkpoint of the previous rung is continued up to the new number of epochs
+            train_model(cfg, resume=True)
+        except Exception as e:
+            traceback.print_exc()
+            result['status'] = f'failed: {e}'
+    result['duration_s'] = time.perf_counter() - start
+
+    # read back from the checkpoint, data-parallel trials do not return their loss
+    checkpoint = load_checkpoint(get_checkpoint_path(cfg['model_name'], models_dir))
+    if checkpoint is None:
+        result.update({'epochs': 0, 'val_loss': None, 'converged': False})
+    else:
+        result.update({'epochs': checkpoint['epoch'] + 1, 'val_loss': checkpoint['best_loss'],
+                       'converged': checkpoint.get('converged', checkpoint['convergence'] > cfg['convergence'])})
+    return result
+
+
+def load_history(output_dir):
+    history_path = os.path.join(output_dir, 'search.json')
+    if not os.path.exists(history_path):
+        return None
+    with open(history_path, 'r') as f:
+        return json.load(f)
+
+
+def save_history(history, output_dir):
+    history_path = os.path.join(output_dir, 'search.json')
+    with open(history_path + '.tmp', 'w') as f:
+        json.dump(history, f, indent=2)
+    os.replace(history_path + '.tmp', history_path)
+
+
+def _ranked(results, trials):
+    # failed trials rank last
+    return sorted(trials, key=lambda trial: (results[str(trial)]['val_loss'] is None,
+                                             results[str(trial)]['val_loss'] or 0.0))
+
+
+def run_search(base, space, num_trials=27, min_epochs=1, max_epochs=27, eta=3, output_dir=None, seed=42,
+               cores_per_job=1, num_workers=None):
+    output_dir = output_dir or os.path.join(SEARCHES_ROOT, time.strftime('%Y%m%d-%H%M%S'))
+    os.makedirs(output_dir, exist_ok=True)
+
+    history = load_history(output_dir)
+    if history is None:
+        rng = random.Random(seed)
+        history = {
+            'base': base,
+            'space': space,
+            'rungs': get_rungs(min_epochs, max_epochs, eta),
+            'eta': eta,
+            'trials': [dict(base, **sample_configuration(space, rng)) for _ in range(num_trials)],
+            'results': [],
+        }
+        save_history(history, output_dir)
+    elif json.loads(json.dumps(space)) != history.get('space', json.loads(json.dumps(space))):
+        # the sampled trials belong to the space the search started with
+        print(f"The search in {output_dir} was started with the space {history['space']}, "
+              f'use another output_dir to search {space}')
+        return None
+    else:
+        print(f"Resuming the search in {output_dir}, {len(history['results'])} rungs started")
+
+    # the sets are created once here instead of by every trial at the same time
+    if not os.path.exists('sets'):
+        from code.training.auxiliary import create_sets
+        create_sets(history['base'].get('dataset_path', 'hand_gestures'))
+
+    survivors = list(range(len(history['trials'])))
+    # by default one worker per group of cores_per_job cores, so the trials of a rung fill the machine
+    with create_pool(num_workers, cores_per_job) as executor:
+        for rung, epochs in enumerate(history['rungs']):
+            if rung == len(history['results']):
+                history['results'].append({})
+            results = history['results'][rung]
+            pending = {executor.submit(_train_trial, _trial_dir(output_dir, trial), history['trials'][trial],
+                                       epochs): trial for trial in survivors if str(trial) not in results}
+            print(f'Rung {rung}: {len(survivors)} trials for {epochs} epochs, {len(pending)} to train')
+            for future, trial in pending.items():
+                results[str(trial)] = future.result()
+                save_history(history, output_dir)
+                print(f"Trial {trial}: {results[str(trial)]['status']}, validation loss "
+                      f"{results[str(trial)]['val_loss']} after {results[str(trial)]['epochs']} epochs")
+
+            ranked = _ranked(results, survivors)
+            if rung < len(history['rungs']) - 1:
+                survivors = ranked[:max(1, len(ranked) // history['eta'])]
+            else:
+                survivors = ranked[:1]
+
+    best = survivors[0]
+    history['best'] = {'trial': best, 'config': history['trials'][best],
+                       'models_dir': os.path.join(_trial_dir(output_dir, best), 'models'),
+                       'val_loss': history['results'][-1][str(best)]['val_loss']}
+    save_history(history, output_dir)
+    searched = {key: value for key, value in history['trials'][best].items() if key in space}
+    print(f"Best trial {best}, validation loss {history['best']['val_loss']}: {searched}")
+    return history['best']
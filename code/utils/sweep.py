@@ -0,0 +1,143 @@
+import os
+import csv
+import json
+import time
+import shutil
+import itertools
+import traceback
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+"""
+    Parallel sweeps: every job is a set of create_configuration_file arguments, run in its own worker process
+    with its own config file under the sweep folder. Every job writes into a models directory of its own,
+    starting from a copy of the shared model folder, so concurrent jobs on one model never write the same
+    weights, traced graphs or performance files. Workers are pinned to disjoint groups of cores and limit torch to
+    as many threads, so concurrent jobs never oversubscribe the machine, and the results of all jobs are
+    collected in summary.csv and summary.json.
+"""
+
+SWEEPS_ROOT = 'sweeps'
+
+
+def expand_grid(base=None, **grid):
+    # expand_grid({'pretrained_model': True}, model_name=['resnet-fc-18', 'vgg-classifier-16'], seed=[1, 2])
+    keys = list(grid.keys())
+    return [dict(base or {}, **dict(zip(keys, values))) for values in itertools.product(*grid.values())]
+
+
+def get_core_groups(cores_per_job=1):
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    groups = [cores[i:i + cores_per_job] for i in range(0, len(cores) - cores_per_job + 1, cores_per_job)]
+    return groups or [cores]
+
+
+def _pin_worker(core_queue):
+    # each worker process takes one core group for its whole life
+    cores = core_queue.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    os.environ['OMP_NUM_THREADS'] = str(len(cores))
+    import torch
+    torch.set_num_threads(len(cores))
+    torch.set_num_interop_threads(1)
+
+
+def _job_dir(output_dir, index, job):
+    return os.path.join(output_dir, f"{index:03d}_{job.get('model_name', 'job')}")
+
+
+def _run_job(index, job, output_dir, task):
+    from code.utils.configuration import create_configuration_file, load_configuration_file
+    from code.training.train_model import train_model, test_model
+
+    job_dir = _job_dir(output_dir, index, job)
+    config_path = os.path.join(job_dir, 'config.yaml')
+    os.makedirs(job_dir, exist_ok=True)
+
+    # the weights and the files saved next to them (architecture, traced and int8 models) are copied into the
+    # models folder of the job, the results of every job stay in its own folder
+    model_name = job.get('model_name', 'resnet-fc-50')
+    shared_dir = job.get('models_dir', 'models')
+    models_dir = os.path.join(job_dir, 'models')
+    model_dir = os.path.join(shared_dir, model_name)
+    if (task == 'test' or job.get('pretrained_model')) and os.path.isdir(model_dir):
+        shutil.copytree(model_dir, os.path.join(models_dir, model_name), dirs_exist_ok=True,
+                        ignore=shutil.ignore_patterns('performance', 'feature_cache', 'checkpoint*'))
+    os.makedirs(os.path.join(models_dir, model_name, 'performance'), exist_ok=True)
+
+    create_configuration_file(**dict(job, models_dir=models_dir, config_path=config_path))
+    cfg = load_configuration_file(config_path)
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    row = {'job': index, 'model_name': model_name, 'task': task, 'status': 'ok', 'cores': cores}
+    row.update({key: value for key, value in job.items() if key != 'model_name'})
+    start = time.perf_counter()
+    with open(os.path.join(job_dir, 'log.txt'), 'w') as log, contextlib.redirect_stdout(log), \
+            contextlib.redirect_stderr(log):
+        try:
+            if task in ['train', 'train_test']:
+                row['best_val_loss'] = train_model(cfg)
+                cfg['pretrained_model'] = True
+            if task in ['test', 'train_test']:
+                results = test_model(cfg)
+                row.update({f'test_{key}': value for key, value in results.items()})
+        except Exception as e:
+            traceback.print_exc()
+            row['status'] = f'failed: {e}'
+    row['duration_s'] = time.perf_counter() - start
+    return row
+
+
+def write_summary(rows, output_dir):
+    fieldnames = []
+    for row in rows:
+        fieldnames += [key for key in row.keys() if key not in fieldnames]
+    with open(os.path.join(output_dir, 'summary.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+        json.dump(rows, f, indent=2, default=str)
+
+    columns = ['job', 'model_name', 'status', 'duration_s'] + \
+              [key for key in fieldnames if key.startswith('test_') or key == 'best_val_loss']
+    print(' | '.join(columns))
+    for row in rows:
+        print(' | '.join('{:.4g}'.format(row[key]) if isinstance(row.get(key), float) else str(row.get(key))
+                         for key in columns))
+    print(f"Summary written to {os.path.join(output_dir, 'summary.csv')}")
+
+
+def create_pool(num_workers=None, cores_per_job=1):
+    # executor workers are not daemonic, so jobs can start their own dataloader workers and ranks
+    core_groups = get_core_groups(cores_per_job)
+    num_workers = min(num_workers or len(core_groups), len(core_groups))
+    context = multiprocessing.get_context('spawn')
+    core_queue = context.Queue()
+    for cores in core_groups[:num_workers]:
+        core_queue.put(cores)
+    print(f'Starting {num_workers} workers of {len(core_groups[0])} cores')
+    return ProcessPoolExecutor(num_workers, mp_context=context, initializer=_pin_worker, initargs=(core_queue,))
+
+
+def run_sweep(jobs, task='test', output_dir=None, cores_per_job=1, num_workers=None):
+    # task is 'train', 'test' or 'train_test'
+    output_dir = output_dir or os.path.join(SWEEPS_ROOT, time.strftime('%Y%m%d-%H%M%S'))
+    os.makedirs(output_dir, exist_ok=True)
+
+    print(f'Running {len(jobs)} jobs in {output_dir}')
+    start = time.perf_counter()
+    with create_pool(min(num_workers or len(jobs), len(jobs)), cores_per_job) as executor:
+        pending = [executor.submit(_run_job, index, job, output_dir, task) for index, job in enumerate(jobs)]
+        rows = []
+        for result in pending:
+            row = result.result()
+            print(f"Job {row['job']} ({row['model_name']}) {row['status']} in {row['duration_s']:.1f}s")
+            rows.append(row)
+
+    print(f'Sweep finished in {time.perf_counter() - start:.1f}s, '
+          f"{sum(row['duration_s'] for row in rows):.1f}s of work")
+    write_summary(rows, output_dir)
+    return rows
@@ -1,136 +1,37 @@
 import os
 
-from code.training.train_model import train_model, test_model
-from code.utils.configuration import create_configuration_file, load_configuration_file
+from code.utils.sweep import run_sweep
 from code.training.auxiliary import create_sets
 
+MODEL_NAMES = [
+    'resnet-fc-101',
+    'resnet-fc-50',
+    'resnet-fc-18',
+    'resnet-scratch-101',
+    'resnet-scratch-50',
+    'resnet-scratch-18',
+    'vgg-scratch-16',
+    'vgg-classifier-16',
+    'densenet-classifier-121',
+    'densenet-scratch-121',
+    'efficientnet_scratch_b0',
+    'efficientnet_classifier_b0',
+    'inception_scratch_v3',
+    'inception_fc_v3',
+    'custom_densenet_3_3_3',
+    'custom_densenet_3_3_3_cifar',
+    'custom_resnet_3_3_3',
+    'custom_resnet_3_3_3_cifar',
+    'custom_senet_3_3_3',
+    'custom_senet_3_3_3_cifar',
+]
+
 if __name__ == '__main__':
     os.environ['TORCH_HOME'] = './cache'
 
     create_sets('hand_gestures')
 
-    create_configuration_file(model_name='resnet-fc-101', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='resnet-fc-50', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='resnet-fc-18', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='resnet-scratch-101', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='resnet-scratch-50', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='resnet-scratch-18', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='vgg-scratch-16', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='vgg-classifier-16', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='densenet-classifier-121', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='densenet-scratch-121', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='densenet-classifier-121', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='efficientnet_scratch_b0', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='efficientnet_classifier_b0', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='inception_scratch_v3', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='inception_fc_v3', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='custom_densenet_3_3_3', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='custom_densenet_3_3_3_cifar', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='custom_resnet_3_3_3', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='custom_resnet_3_3_3_cifar', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='custom_senet_3_3_3', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
-
-    create_configuration_file(model_name='custom_senet_3_3_3_cifar', pretrained_weights=False)
-    cfg = load_configuration_file('config.yaml')
-    cfg['pretrained_weights'] = False
-    cfg['pretrained_model'] = True
-    test_model(cfg)
+    # every model is tested in its own process, config file and output folder, on its own cores
+    jobs = [dict(model_name=model_name, pretrained_weights=False, pretrained_model=True)
+            for model_name in MODEL_NAMES]
+    run_sweep(jobs, task='test')